@@ -0,0 +1,52 @@
+# Render time against the number of overlay triggers
+# Generates a synthetic clip and image with ffmpeg, then renders it with N triggers of the same overlay.
+#   python bench/overlays.py --triggers 1 10 40 100 --seconds 20
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from memecat import MemeCat
+
+
+def make_fixtures(folder:str, seconds:float, size='1280x720'):
+    video = os.path.join(folder, 'clip.mp4')
+    image = os.path.join(folder, 'meme.png')
+    ass = os.path.join(folder, 'empty.ass')
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30:duration={seconds}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}", "-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", "-shortest", video], check=True)
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i", "color=c=red:size=320x240:duration=1", "-frames:v", "1", image], check=True)
+    with open(ass, 'w', encoding='utf-8') as f:
+        f.write("[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n")
+    return video, image, ass
+
+def triggers(image:str, count:int, seconds:float, duration=0.8) -> list[dict]:
+    """ `count` hits spread over the clip, like one meme image recurring through a talk """
+    step = seconds / count
+    return [{'src': image, 'margin_y': 10, 'start_time': round(i * step, 3), 'end_time': round(i * step + duration, 3)} for i in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MemeCat.write against the number of overlay triggers")
+    parser.add_argument('--triggers', type=int, nargs='+', default=[1, 10, 40, 100])
+    parser.add_argument('--seconds', type=float, default=20.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='memecat-bench-') as folder:
+        video, image, ass = make_fixtures(folder, args.seconds)
+        output = os.path.join(folder, 'out.mp4')
+        print(f"{'triggers':>9} {'inputs':>7} {'nodes':>6} {'render s':>9}")
+        for count in args.triggers:
+            overlays = triggers(image, count, args.seconds)
+            command = MemeCat.build_command(video, output, ass, overlays=overlays, audio_effects=[])
+            graph = command[command.index('-filter_complex') + 1]
+            t = time.time()
+            subprocess.run(command[:1] + ["-v", "error"] + command[1:], check=True)
+            print(f"{count:>9} {command.count('-i') - 1:>7} {graph.count('overlay='):>6} {time.time() - t:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
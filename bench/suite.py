@@ -0,0 +1,379 @@
+# Offline benchmark suite: SemanticDict, EffectBucket, generate_subtitles and ffmpeg command construction
+# The sentence transformer is replaced by a deterministic hash embedder (lib/stubs.py), so nothing is downloaded
+# and every machine searches the same vectors. Results are saved as JSON and compared against a baseline.
+# Timings only compare on the same machine: bench/baselines/quick.json is a --quick run with its `meta` (python,
+# numpy, platform) to check against there, anywhere else save your own baseline from a clean checkout first.
+#   python bench/suite.py run --quick --compare bench/baselines/quick.json
+#   python bench/suite.py run --save bench/baselines/mine.json
+#   python bench/suite.py compare bench/baselines/mine.json after.json --tolerance 0.2
+#   python bench/suite.py startup
+#   python bench/suite.py server
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib.semdict import DTYPES, SemanticDict
+from lib.stubs import use_stub_embedder
+from memecat import EffectBucket, MemeCat, volume_expression
+
+SEED = 1234
+KEY_SIZES = [10, 1_000, 100_000]
+WORD_SIZES = [1_000, 10_000, 100_000]
+OVERLAY_SIZES = [10, 100, 1_000]
+QUICK_LIMIT = 10_000 # --quick skips anything bigger
+HEAVY_MODULES = ('torch', 'whisper', 'sentence_transformers') # loaded on first use, never by importing memecat
+EFFECTS = [('color', '"FF0000"'), ('font_size', 240), ('italic', None), ('rotate_z', 45), ('blur_edges', 40), ('underline', None)]
+
+
+def vocabulary(size=5000) -> list[str]:
+    """ Pronounceable made up words, the same on every run """
+    rng = np.random.default_rng(SEED)
+    consonants, vowels = list("bcdfghklmnprstvz"), list("aeiou")
+    words = set()
+    while len(words) < size:
+        length = int(rng.integers(1, 4))
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(length)))
+    return sorted(words)
+
+def phrases(count:int, vocab:list[str], seed=SEED) -> list[str]:
+    """ `count` distinct keys of one to three words """
+    rng = np.random.default_rng(seed)
+    found = dict()
+    while len(found) < count:
+        lengths = rng.integers(1, 4, size=count)
+        picks = rng.integers(0, len(vocab), size=(count, 3))
+        for length, row in zip(lengths, picks):
+            found[" ".join(vocab[i] for i in row[:length])] = None
+    return list(found)[:count]
+
+def word_list(count:int, vocab:list[str], seed=SEED) -> list[tuple[float, float, str]]:
+    """ A synthetic transcript: `count` words, a few per second, drawn from a Zipf-like distribution like speech """
+    rng = np.random.default_rng(seed)
+    ranks = np.minimum(rng.zipf(1.3, size=count), len(vocab)) - 1
+    words, t = [], 0.0
+    for rank in ranks:
+        length = float(rng.uniform(0.15, 0.5))
+        words.append((round(t, 3), round(t + length, 3), vocab[rank]))
+        t += length + float(rng.uniform(0.0, 0.2))
+    return words
+
+def write_bucket(path:str, keys:list[str], image:str):
+    effects = []
+    for i, key in enumerate(keys):
+        name, arg = EFFECTS[i % len(EFFECTS)]
+        effects.append([key, name] + ([] if arg is None else [arg]) if i % 50 else [key, 'image', 'meme'])
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump({'overlays': {'meme': {'src': image, 'margin_y': 10, 'duration': 0.8}}, 'effects': effects}, f)
+
+
+# Every case is (name, size, setup). `setup()` builds its inputs and returns the function to time, so only
+# the work itself is measured. That function may return a dict of extra metrics to keep with the timings.
+
+def cases(folder:str):
+    vocab = vocabulary()
+    keys = phrases(max(KEY_SIZES), vocab)
+    queries = phrases(1000, vocab, seed=SEED + 1)
+    image = os.path.join(folder, 'meme.png')
+
+    def filled(size):
+        d = SemanticDict()
+        d.add_many([(key, i) for i, key in enumerate(keys[:size])])
+        return d
+
+    for size in KEY_SIZES:
+        def add(size=size):
+            d = SemanticDict()
+            items = keys[:size]
+            def run():
+                for i, key in enumerate(items):
+                    d.add(key, i)
+            return run
+        def add_many(size=size):
+            d = SemanticDict()
+            items = [(key, i) for i, key in enumerate(keys[:size])]
+            return lambda: d.add_many(items)
+        def get(size=size):
+            d = filled(size)
+            def run():
+                for query in queries[:200]:
+                    d.get(query, n=3, threshold=0.5)
+            return run
+        def get_many(size=size):
+            d = filled(size)
+            return lambda: d.get_many(queries, n=3, threshold=0.5)
+        yield 'semdict.add', size, add
+        yield 'semdict.add_many', size, add_many
+        yield 'semdict.get', size, get
+        yield 'semdict.get_many', size, get_many
+
+    # the approximate index against exact search, on captions that are a key plus one more word
+    rng = np.random.default_rng(SEED + 4)
+    near = [f"{keys[i]} {vocab[j]}" for i, j in zip(rng.integers(0, len(keys), 1000), rng.integers(0, len(vocab), 1000))]
+    exact = {}
+    for nprobe in [4, 16, 64]:
+        def get_many_ivf(nprobe=nprobe, size=max(KEY_SIZES)):
+            if size not in exact:
+                exact[size] = filled(size).get_many(near, n=10, threshold=2.0)
+            d = filled(size)
+            d.set_index('ivf', nprobe=nprobe)
+            d.build_index()
+            def run():
+                found = d.get_many(near, n=10, threshold=2.0)
+                return {
+                    'recall@1': float(np.mean([bool(a) and bool(b) and a[0][0] == b[0][0] for a, b in zip(exact[size], found)])),
+                    'recall@10': float(np.mean([len({r[0] for r in a} & {r[0] for r in b}) / max(1, len(a)) for a, b in zip(exact[size], found)])),
+                }
+            return run
+        yield f'semdict.get_many_ivf{nprobe}', max(KEY_SIZES), get_many_ivf
+
+    # compact storage: memory against speed and agreement with float32
+    for dtype in ['float16', 'int8']:
+        def get_many_dtype(dtype=dtype, size=max(KEY_SIZES)):
+            if size not in exact:
+                exact[size] = filled(size).get_many(near, n=10, threshold=2.0)
+            d = SemanticDict(dtype=dtype)
+            d.add_many([(key, i) for i, key in enumerate(keys[:size])])
+            def run():
+                found = d.get_many(near, n=10, threshold=2.0)
+                return {
+                    'matrix_mb': (d.matrix.nbytes + (0 if d._scales is None else 4 * len(d))) / 2**20,
+                    'recall@1': float(np.mean([bool(a) and bool(b) and a[0][0] == b[0][0] for a, b in zip(exact[size], found)])),
+                }
+            return run
+        yield f'semdict.get_many_{dtype}', max(KEY_SIZES), get_many_dtype
+
+    # search speed per storage dtype, one query at a time and in batches
+    for dtype in DTYPES:
+        def stored(dtype=dtype, size=10_000):
+            d = SemanticDict(dtype=dtype)
+            d.add_many([(key, i) for i, key in enumerate(keys[:size])])
+            return d
+        def get_dtype(dtype=dtype):
+            d = stored(dtype)
+            def run():
+                for query in queries[:200]:
+                    d.get(query, n=3, threshold=0.5)
+            return run
+        def get_many_dtype(dtype=dtype):
+            d = stored(dtype)
+            return lambda: d.get_many(queries, n=3, threshold=0.5)
+        yield f'semdict.search_{dtype}.get', 10_000, get_dtype
+        yield f'semdict.search_{dtype}.get_many', 10_000, get_many_dtype
+
+    for size in [1_000, 10_000]:
+        path = os.path.join(folder, f'bucket{size}.yml')
+        def load(size=size, path=path):
+            if not os.path.exists(path):
+                write_bucket(path, phrases(size, vocab, seed=SEED + 2), image)
+            return lambda: EffectBucket(path)
+        yield 'bucket.load_from_yaml', size, load
+
+    bucket_path = os.path.join(folder, 'bucket_subtitles.yml')
+    for size in WORD_SIZES:
+        def subtitles(size=size):
+            if not os.path.exists(bucket_path):
+                write_bucket(bucket_path, phrases(1_000, vocab, seed=SEED + 3), image)
+            bucket, words = EffectBucket(bucket_path), word_list(size, vocab)
+            def run():
+                ass, overlays, audio, top_k, full_text = MemeCat.generate_subtitles(words, bucket, words_per_line=1, threshold=0.3, search_n=2)
+                return {'overlays': len(overlays), 'ass_bytes': len(ass), **{f"search_cache_{k}": v for k, v in bucket.cache_info().items() if k in ('hits', 'misses')}}
+            return run
+        yield 'generate_subtitles', size, subtitles
+
+    for size in OVERLAY_SIZES:
+        def command(size=size):
+            # a handful of images recurring through the clip, at a couple of sizes and placements
+            overlays = [{'src': os.path.join(folder, f'meme{i % 7}.png'), 'width': 300 + 100 * (i % 2), 'alignment': ['top', 'middle', 'bottom'][i % 3],
+                         'start_time': i * 1.5, 'end_time': i * 1.5 + 0.8} for i in range(size)]
+            audio = [{'volume': 0.5, 'start': i * 3.0, 'end': i * 3.0 + 1.0} for i in range(size // 4)]
+            def run():
+                command = MemeCat.build_command('in.mp4', 'out.mp4', os.path.join(folder, 'subs.ass'), overlays=overlays, audio_effects=audio)
+                return {'inputs': command.count('-i') - 1, 'graph_bytes': len(command[command.index('-filter_complex') + 1])}
+            return run
+        yield 'build_command', size, command
+
+    for size in [2_000, 5_000]:
+        def volume(size=size):
+            # hits every few seconds, now and then overlapping the previous one
+            audio = [{'volume': [0.5, 0.0, 2.0][i % 3], 'start': i * 2.5, 'end': i * 2.5 + (3.0 if i % 7 == 0 else 1.0)} for i in range(size)]
+            def run():
+                return {'expression_bytes': len(volume_expression(audio))}
+            return run
+        yield 'volume_expression', size, volume
+
+    def fresh_import():
+        # a fresh interpreter, so nothing is imported yet
+        return lambda: subprocess.run([sys.executable, "-c", "import memecat"], cwd=ROOT, check=True)
+    yield 'import_memecat', 1, fresh_import
+
+
+def measure(setup, repeat:int, budget:float) -> dict:
+    """ Time `repeat` runs (fewer once `budget` seconds are spent), each on freshly set up inputs """
+    runs, metrics = [], {}
+    while len(runs) < repeat and (not runs or sum(runs) < budget):
+        fn = setup()
+        t = time.perf_counter()
+        result = fn()
+        runs.append(time.perf_counter() - t)
+        metrics = result if isinstance(result, dict) else {}
+    return {'best': min(runs), 'median': statistics.median(runs), 'runs': len(runs), **({'metrics': metrics} if metrics else {})}
+
+def run(only=None, quick=False, repeat=5, budget=2.0) -> dict:
+    use_stub_embedder()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='memecat-bench-') as folder:
+        for name, size, setup in cases(folder):
+            label = f"{name}[{size}]"
+            if (quick and size > QUICK_LIMIT) or (only and not any(fnmatch.fnmatch(label, pattern) for pattern in only)):
+                continue
+            results[label] = measure(setup, repeat, budget)
+            metrics = "".join(f"  {k}={v:.3g}" if isinstance(v, float) else f"  {k}={v}" for k, v in results[label].get('metrics', {}).items())
+            print(f"{label:<36} {results[label]['best'] * 1000:>12.3f} ms  ({results[label]['runs']} runs){metrics}", flush=True)
+    return {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'platform': platform.platform(), 'time': time.time()},
+        'results': results,
+    }
+
+def compare(baseline:dict, current:dict, tolerance=0.2, floor=0.001) -> list[str]:
+    """ Print a before/after table and return the benchmarks at least `tolerance` slower (and `floor` seconds, to skip noise) """
+    regressions = []
+    print(f"{'benchmark':<36} {'baseline ms':>12} {'current ms':>12} {'change':>8}")
+    for label, now in current['results'].items():
+        before = baseline['results'].get(label)
+        if before is None:
+            print(f"{label:<36} {'-':>12} {now['best'] * 1000:>12.3f} {'new':>8}")
+            continue
+        change = now['best'] / before['best'] - 1 if before['best'] else 0.0
+        slower = change > tolerance and now['best'] - before['best'] > floor
+        if slower:
+            regressions.append(label)
+        print(f"{label:<36} {before['best'] * 1000:>12.3f} {now['best'] * 1000:>12.3f} {change:>+8.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+def startup(limit=2.0) -> list[str]:
+    """ Import memecat in a fresh interpreter and return what is wrong: heavy modules it pulled in, or taking over `limit` seconds """
+    code = (
+        "import json, sys, time; t = time.perf_counter(); import memecat; seconds = time.perf_counter() - t; "
+        f"print(json.dumps({{'seconds': seconds, 'heavy': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))"
+    )
+    result = json.loads(subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True, text=True).stdout)
+    print(f"import memecat: {result['seconds'] * 1000:.1f} ms (limit {limit * 1000:.0f} ms), heavy modules: {', '.join(result['heavy']) or 'none'}")
+    problems = [f"importing memecat imports {m}" for m in result['heavy']]
+    if result['seconds'] > limit:
+        problems.append(f"importing memecat took {result['seconds']:.2f}s")
+    return problems
+
+def server_check(jobs=3, timeout=120.0) -> list[str]:
+    """ Run jobs through a RenderServer with the stub models and return what is wrong with their status and metrics (needs ffmpeg) """
+    from lib.server import RenderServer
+    problems = []
+    with tempfile.TemporaryDirectory(prefix='memecat-server-check-') as folder:
+        video = os.path.join(folder, 'input.mp4')
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25:duration=3",
+            "-f", "lavfi", "-i", "sine=frequency=440:duration=3", "-shortest", video,
+        ], check=True)
+        render = RenderServer({'bucket_path': os.path.join(ROOT, 'buckets', 'nate.yml')}, asr_workers=1, render_workers=1, stub=True)
+        try:
+            try:
+                render.submit({'input': video, 'output': os.path.join(folder, 'typo.mp4'), 'font_sise': 100})
+                problems.append("a job with an unknown setting was accepted")
+            except ValueError:
+                pass
+            ids = [render.submit({'input': video, 'output': os.path.join(folder, f"out{i}.mp4"), 'words': 2})['id'] for i in range(jobs)]
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                metrics = render.metrics()
+                if metrics['jobs']['transcribing'] > render.asr_workers:
+                    problems.append(f"{metrics['jobs']['transcribing']} jobs transcribing on {render.asr_workers} worker(s)")
+                if metrics['queue_depth'] != metrics['jobs']['queued'] + metrics['jobs']['render_queued']:
+                    problems.append(f"queue depth {metrics['queue_depth']} does not add up: {metrics['jobs']}")
+                if all(render.status(job_id)['status'] in ('done', 'failed') for job_id in ids):
+                    break
+                time.sleep(0.05)
+            statuses = [render.status(job_id) for job_id in ids]
+            for status in statuses:
+                if status['status'] != 'done':
+                    problems.append(f"job {status['id']} is {status['status']} {status.get('error', '')}".strip())
+                elif not os.path.isfile(status['output']):
+                    problems.append(f"job {status['id']} is done but {status['output']} is missing")
+            metrics = render.metrics()
+            print(f"{jobs} jobs: {Counter(s['status'] for s in statuses)}, total latency {metrics['latency_seconds']['total']}")
+            if metrics['done'] != sum(s['status'] == 'done' for s in statuses) or metrics['active'] != 0:
+                problems.append(f"metrics disagree with the jobs: done {metrics['done']}, active {metrics['active']}")
+        finally:
+            render.close()
+    return sorted(set(problems), key=problems.index)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline MemeCat benchmarks or compare two result files")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('--only', nargs='+', default=None, help="Only benchmarks matching these patterns, e.g. 'semdict.*' 'build_command[1000]'")
+    run_parser.add_argument('--quick', action='store_true', help=f"Skip sizes above {QUICK_LIMIT}")
+    run_parser.add_argument('--repeat', type=int, default=5, help="Runs per benchmark, the best one counts")
+    run_parser.add_argument('--budget', type=float, default=2.0, help="Stop repeating a benchmark once it has taken this many seconds")
+    run_parser.add_argument('--save', default=None, help="Write the results as JSON here (e.g. a new baseline)")
+    run_parser.add_argument('--compare', default=None, help="Baseline JSON to compare the results against")
+    run_parser.add_argument('--tolerance', type=float, default=0.2, help="How much slower than the baseline counts as a regression")
+    compare_parser = commands.add_parser('compare', help="Compare two saved result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.2, help="How much slower than the baseline counts as a regression")
+    startup_parser = commands.add_parser('startup', help=f"Check that importing memecat stays fast and loads none of {', '.join(HEAVY_MODULES)}")
+    startup_parser.add_argument('--limit', type=float, default=2.0, help="Most seconds the import may take")
+    server_parser = commands.add_parser('server', help="Check job submission, status and metrics of the render server with the stub models")
+    server_parser.add_argument('--jobs', type=int, default=3, help="Jobs to submit at once")
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        problems = startup(args.limit)
+        if problems:
+            print(f"Startup check failed: {'; '.join(problems)}")
+            sys.exit(1)
+        return
+
+    if args.command == 'server':
+        problems = server_check(args.jobs)
+        if problems:
+            print(f"Server check failed: {'; '.join(problems)}")
+            sys.exit(1)
+        return
+
+    if args.command == 'run':
+        current = run(only=args.only, quick=args.quick, repeat=args.repeat, budget=args.budget)
+        if args.save:
+            os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+            with open(args.save, 'w', encoding='utf-8') as f:
+                json.dump(current, f, indent=1)
+        baseline_path = args.compare
+    else:
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+    if baseline_path is None:
+        return
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(baseline, current, tolerance=args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# Search index backends for SemanticDict
+# `ExactIndex` scores every key. `IVFIndex` clusters the keys (spherical k-means, plain numpy) and only scores
+# the keys in the few clusters closest to each query, trading a little recall for a lot of speed on big buckets.
+# Both work through the dict's `vectors()` and `similarity()`, so they never need the embeddings in float32.
+
+import numpy as np
+
+INDEXES = ('exact', 'ivf')
+
+def nearest_centroids(vectors:np.ndarray, centroids:np.ndarray, block=8192) -> np.ndarray:
+    """ Index of the most similar centroid for every row, in blocks so the score matrix stays small """
+    assign = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), block):
+        assign[i:i + block] = np.argmax(vectors[i:i + block] @ centroids.T, axis=1)
+    return assign
+
+def spherical_kmeans(vectors:np.ndarray, k:int, iterations=10, seed=0) -> np.ndarray:
+    """ `k` unit length centroids of unit length `vectors`, clustered by cosine similarity """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroids(vectors, centroids)
+        counts = np.bincount(assign, minlength=k)
+        order = np.argsort(assign, kind='stable')
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = np.flatnonzero(counts == 0)
+        if len(empty): # restart empty clusters on random points
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids /= norms
+    return centroids
+
+
+class ExactIndex:
+    """ Brute force: every query is scored against every key """
+    name = 'exact'
+
+    def build(self, store):
+        pass
+
+    def search(self, store, queries:np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+        """ (rows, cosine distances) scored in `store` (a SemanticDict) for each normalized query, rows None meaning every row in order """
+        return [(None, distances) for distances in 1.0 - store.similarity(queries)]
+
+
+class IVFIndex:
+    """
+    Inverted file index: the keys are split into `nlist` clusters and a query only scores the keys of its
+    `nprobe` nearest clusters. Raising `nprobe` raises recall (nprobe >= nlist is exact) at the cost of speed.
+
+    Below `min_size` keys no clusters are built and every query is scored exactly, which is both faster and
+    exact at that size. Every probed cluster is scored with one matrix product for all the queries probing it.
+
+    Parameters:
+    - nprobe (int): Clusters searched per query.
+    - nlist (int): Number of clusters. Defaults to about sqrt(number of keys).
+    - min_size (int): Smallest number of keys worth clustering.
+    - train_size (int): At most this many keys per cluster are sampled to train the clusters.
+    - iterations (int): k-means iterations.
+    """
+    name = 'ivf'
+
+    def __init__(self, nprobe=16, nlist=None, min_size=10000, train_size=64, iterations=10, seed=0):
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.min_size = min_size
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids:np.ndarray = None
+        self.rows:np.ndarray = None # key rows grouped by cluster
+        self.offsets:np.ndarray = None # cluster c holds rows[offsets[c]:offsets[c + 1]]
+
+    def build(self, store, block=8192):
+        size = len(store)
+        if size < self.min_size:
+            self.centroids = self.rows = self.offsets = None
+            return
+        nlist = min(self.nlist or int(np.sqrt(size)), size)
+        rng = np.random.default_rng(self.seed)
+        sample = None if size <= nlist * self.train_size else np.sort(rng.choice(size, nlist * self.train_size, replace=False))
+        self.centroids = spherical_kmeans(store.vectors(sample), nlist, iterations=self.iterations, seed=self.seed)
+        # widen the keys a block at a time, a compact store is never expanded as a whole
+        assign = np.concatenate([nearest_centroids(store.vectors(slice(i, min(i + block, size))), self.centroids) for i in range(0, size, block)])
+        self.rows = np.argsort(assign, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist))))
+
+    def search(self, store, queries:np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+        if self.centroids is None or self.nprobe >= len(self.centroids):
+            return ExactIndex().search(store, queries)
+        probes = np.argpartition(-(queries @ self.centroids.T), self.nprobe - 1, axis=1)[:, :self.nprobe]
+        # visit cluster by cluster, scoring every query that probes it at once
+        pairs = np.argsort(probes, axis=None, kind='stable')
+        owners, clusters = pairs // self.nprobe, probes.ravel()[pairs]
+        cuts = np.flatnonzero(np.diff(clusters)) + 1
+        parts:list[list] = [[] for _ in queries]
+        for group in np.split(np.arange(len(pairs)), cuts):
+            c = clusters[group[0]]
+            start, end = self.offsets[c], self.offsets[c + 1]
+            if start == end:
+                continue
+            distances = 1.0 - store.similarity(queries[owners[group]], self.rows[start:end])
+            for q, d in zip(owners[group], distances):
+                parts[q].append((start, end, d))
+        results = []
+        for found in parts:
+            if not found:
+                results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+                continue
+            rows = np.concatenate([self.rows[start:end] for start, end, _ in found])
+            distances = np.concatenate([d for _, _, d in found])
+            order = np.argsort(rows) # in row order, so ties resolve in insertion order like the exact search
+            results.append((rows[order], distances[order]))
+        return results
+
+
+def make_index(name='exact', **options):
+    """ Index backend by name ('exact' or 'ivf'), with `options` for its constructor """
+    if name == 'exact':
+        return ExactIndex()
+    if name == 'ivf':
+        return IVFIndex(**{k: v for k, v in options.items() if v is not None})
+    raise ValueError(f"Index {name} not found, use one of {', '.join(INDEXES)}.")
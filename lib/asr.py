@@ -0,0 +1,82 @@
+# Parallel chunked transcription
+# The audio is cut at silences, the chunks are transcribed across a process pool and the
+# segments are stitched back together on the absolute timeline.
+
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from lib import models
+from lib.audio import SAMPLE_RATE, split_at_silences
+
+log = logging.getLogger('memecat.asr')
+
+def _init(model_name:str, threads:int):
+    """ Pool initializer: share the cores out between the workers and load whisper once per worker """
+    import torch
+    torch.set_num_threads(threads)
+    models.whisper(model_name)
+
+def _transcribe_chunk(model_name:str, audio_path:str, start:int, end:int, options:dict) -> dict:
+    # every worker maps the same decoded buffer and copies out only its own slice
+    audio = np.array(np.load(audio_path, mmap_mode='r')[start:end])
+    result = models.whisper(model_name).transcribe(audio, **options)
+    return shift_result(result, start / SAMPLE_RATE, len(audio) / SAMPLE_RATE)
+
+def shift_result(result:dict, offset:float, duration:float) -> dict:
+    """ Move a chunk's segments and words onto the absolute timeline, clamped to the chunk so nothing crosses a cut """
+    def shift(t):
+        return offset + min(max(float(t), 0.0), duration)
+    segments = []
+    for seg in result['segments']:
+        seg = dict(seg, start=shift(seg['start']), end=shift(seg['end']))
+        if 'words' in seg:
+            seg['words'] = [dict(w, start=shift(w['start']), end=shift(w['end'])) for w in seg['words']]
+        segments.append(seg)
+    return {'segments': segments, 'language': result.get('language')}
+
+def transcribe_parallel(audio:np.ndarray, model_name='small', workers=2, chunk_seconds=60.0, **options) -> dict:
+    """
+    Transcribe `audio` (16 kHz mono float32) in silence separated chunks on `workers` processes.
+
+    Every word lands in exactly one chunk because the cuts are made inside silences, so stitching is just
+    offsetting each chunk's timestamps and concatenating in order.
+
+    Returns:
+    - dict: A whisper style result with 'segments' (renumbered) and 'language' (of the first chunk).
+    """
+    boundaries = split_at_silences(audio, SAMPLE_RATE, chunk_seconds=chunk_seconds)
+    chunks = [(int(start * SAMPLE_RATE), int(end * SAMPLE_RATE)) for start, end in zip(boundaries, boundaries[1:])]
+    log.info("Transcribing %d chunks on %d workers", len(chunks), workers)
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='memecat-audio-') as tmp:
+        # hand the buffer to the workers as a memory-mapped file instead of pickling every chunk
+        audio_path = os.path.join(tmp, 'audio.npy')
+        np.save(audio_path, np.asarray(audio, dtype=np.float32))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init, initargs=(model_name, threads)) as pool:
+            futures = [pool.submit(_transcribe_chunk, model_name, audio_path, start, end, options) for start, end in chunks]
+            results = [f.result() for f in futures]
+
+    segments = [seg for r in results for seg in r['segments']]
+    for i, seg in enumerate(segments):
+        seg['id'] = i
+    return {'segments': segments, 'language': results[0]['language'] if results else None}
+
+def transcribe_stream(audio:np.ndarray, model_name='small', chunk_seconds=60.0, **options):
+    """
+    Transcribe `audio` one silence separated chunk at a time, yielding each chunk's segments (on the absolute
+    timeline) as soon as it is done, so later stages can start before the whole file is transcribed.
+    Chunks are cut exactly like `transcribe_parallel` does, so both give the same segments.
+    """
+    model = models.whisper(model_name)
+    boundaries = split_at_silences(audio, SAMPLE_RATE, chunk_seconds=chunk_seconds)
+    for start, end in zip(boundaries, boundaries[1:]):
+        start, end = int(start * SAMPLE_RATE), int(end * SAMPLE_RATE)
+        result = model.transcribe(audio[start:end], **options)
+        yield from shift_result(result, start / SAMPLE_RATE, (end - start) / SAMPLE_RATE)['segments']
@@ -0,0 +1,57 @@
+# Audio helpers: decoding and cheap energy based silence detection
+
+import subprocess
+
+import numpy as np
+
+SAMPLE_RATE = 16000 # what whisper expects
+
+def load_audio(path:str, sr=SAMPLE_RATE) -> np.ndarray:
+    """ Decode the audio of `path` to mono float32 PCM at `sr` Hz through an ffmpeg pipe (like whisper does) """
+    command = ["ffmpeg", "-nostdin", "-threads", "0", "-i", path, "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr), "-"]
+    out = subprocess.run(command, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+def frame_energy_db(audio:np.ndarray, sr=SAMPLE_RATE, frame_ms=30) -> np.ndarray:
+    """ RMS level in dB of consecutive `frame_ms` frames """
+    frame = max(1, int(sr * frame_ms / 1000))
+    count = len(audio) // frame
+    frames = audio[:count * frame].reshape(count, frame)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+def find_silences(audio:np.ndarray, sr=SAMPLE_RATE, threshold_db=-35.0, min_silence=0.3, frame_ms=30) -> list[tuple[float, float]]:
+    """ (start, end) seconds of every stretch at least `min_silence` long that stays `threshold_db` below the loudest frame """
+    energy = frame_energy_db(audio, sr, frame_ms)
+    if len(energy) == 0:
+        return []
+    quiet = energy < energy.max() + threshold_db
+    # edges of runs of quiet frames
+    edges = np.diff(np.concatenate(([0], quiet.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    step = frame_ms / 1000
+    return [(float(s * step), float(e * step)) for s, e in zip(starts, ends) if (e - s) * step >= min_silence]
+
+def split_at_silences(audio:np.ndarray, sr=SAMPLE_RATE, chunk_seconds=60.0, **silence_options) -> list[float]:
+    """ Chunk boundaries in seconds, [0, ..., duration], cutting in the middle of the silence nearest every `chunk_seconds`
+
+    Only silences between half and one and a half chunk lengths from the previous cut are considered. Where there
+    is none (music, wall to wall talking) the cut falls in the middle of the quietest frame of that window, the gap
+    between two words rather than the middle of one.
+    """
+    duration = len(audio) / sr
+    cuts = [(s + e) / 2 for s, e in find_silences(audio, sr, **silence_options)]
+    step = silence_options.get('frame_ms', 30) / 1000
+    energy = frame_energy_db(audio, sr, silence_options.get('frame_ms', 30))
+    boundaries = [0.0]
+    while duration - boundaries[-1] > chunk_seconds * 1.5:
+        last = boundaries[-1]
+        target = last + chunk_seconds
+        window = [c for c in cuts if last + chunk_seconds / 2 <= c <= last + chunk_seconds * 1.5]
+        if window:
+            boundaries.append(min(window, key=lambda c: abs(c - target)))
+        else:
+            first, end = int((last + chunk_seconds / 2) / step), int((last + chunk_seconds * 1.5) / step)
+            boundaries.append((first + int(np.argmin(energy[first:end])) + 0.5) * step)
+    boundaries.append(duration)
+    return boundaries
@@ -0,0 +1,231 @@
+# Batch processing of many videos
+# A fixed pool of worker processes keeps whisper and the embedder warm across jobs and does the
+# transcription + caption work, while ffmpeg renders run on a separate pool so a finished job
+# encodes at the same time as the next one is transcribed.
+
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import yaml
+
+from lib import models, stubs
+from lib.cache import atomic_write
+
+log = logging.getLogger('memecat.batch')
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.mkv', '.webm', '.avi', '.m4v')
+# `MemeCat.prepare` parameters the batch fills in itself, a job cannot set them
+RESERVED = ('input_video', 'keep', 'ass_path', 'transcript', 'transcript_in', 'transcript_out', 'play_res')
+# `MemeCat.burn` settings for the render, which runs outside `prepare`
+RENDER_SETTINGS = ('segments', 'render_workers', 'preview', 'preview_start', 'preview_end', 'preview_hits', 'preview_context', 'preview_height')
+
+
+def check_job(job:dict):
+    """ Raise a ValueError for a job setting neither `MemeCat.prepare` nor the render takes """
+    import inspect
+    from memecat import MemeCat
+    allowed = set(inspect.signature(MemeCat.prepare).parameters) - set(RESERVED) | set(RENDER_SETTINGS) | {'input', 'output'}
+    unknown = sorted(set(job) - allowed)
+    if unknown:
+        raise ValueError(f"Job {job.get('input')} cannot set {', '.join(unknown)}. A job takes input, output, {', '.join(RENDER_SETTINGS)} and the settings of MemeCat.prepare.")
+
+
+def collect_jobs(spec:str, output_dir:str=None, suffix='_memecat') -> list[dict]:
+    """ Build the job list from a directory, a glob pattern or a manifest file
+
+    A manifest is a YAML/JSON list whose items are either input paths or dicts with `input`,
+    optional `output` and `MemeCat.prepare` settings or render settings (segments, render_workers, preview...)
+    to override for that job, `bucket` standing for `bucket_path` like the command line's --bucket.
+    A `.txt` manifest lists one input per line. Outputs default to `<output_dir>/<name><suffix><ext>`.
+    Raises ValueError for a job with settings it cannot take, before anything runs.
+    """
+    if os.path.isdir(spec):
+        entries = sorted(os.path.join(spec, f) for f in os.listdir(spec) if f.lower().endswith(VIDEO_EXTENSIONS))
+    elif os.path.isfile(spec):
+        with open(spec, 'r', encoding='utf-8') as f:
+            if spec.endswith('.txt'):
+                entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            else:
+                entries = yaml.safe_load(f) or [] # YAML is a superset of JSON
+    else:
+        entries = sorted(glob.glob(spec))
+
+    jobs = []
+    for entry in entries:
+        job = {'input': entry} if isinstance(entry, str) else dict(entry)
+        if 'bucket' in job:
+            if 'bucket_path' in job:
+                raise ValueError(f"Job {job.get('input')} sets both bucket and bucket_path.")
+            job['bucket_path'] = job.pop('bucket')
+        check_job(job)
+        if 'output' not in job:
+            name, ext = os.path.splitext(os.path.basename(job['input']))
+            job['output'] = os.path.join(output_dir or os.path.dirname(job['input']), f"{name}{suffix}{ext}")
+        jobs.append(job)
+    return jobs
+
+
+# Worker process side
+
+_buckets = {}
+
+def warm(model:str, stub=False):
+    """ Pool initializer: load the models once per worker process (the offline stand-ins with `stub`) """
+    if stub:
+        stubs.use_stub_models(model)
+    models.whisper(model)
+    models.sentence_transformer()
+
+def cached_bucket(settings:dict):
+    # buckets are compiled once per worker and reused until their yaml changes
+    from memecat import MemeCat
+    path = settings.get('bucket_path')
+    key = (path, os.path.getmtime(path) if path else None, settings.get('match'), settings.get('index'), settings.get('nprobe'), settings.get('embedding_dtype'))
+    if key not in _buckets:
+        _buckets[key] = MemeCat.load_bucket(
+            path,
+            cache_dir=settings.get('cache_dir'),
+            embedding_cache=settings.get('embedding_cache', True),
+            search_cache_size=settings.get('search_cache_size', 4096),
+            match=settings.get('match'),
+            index=settings.get('index'),
+            nprobe=settings.get('nprobe'),
+            embedding_dtype=settings.get('embedding_dtype', 'float32'),
+        )
+    return _buckets[key]
+
+def prepare_job(job:dict, settings:dict, work_dir:str) -> dict:
+    from memecat import MemeCat
+    t = time.time() # a worker picked the job up, so the time before this was spent queued
+    ass_path = os.path.join(work_dir, 'subtitles.ass')
+    keep = []
+    overlays, audio_effects, overlay_table = MemeCat.prepare(job['input'], ass_path=ass_path, bucket=cached_bucket(settings), keep=keep, **settings)
+    # only the overlays this job uses travel back to the main process
+    used = {hit.overlay_id for hit in overlays}
+    overlay_table = {name: config for name, config in overlay_table.items() if name in used}
+    return {'ass_path': ass_path, 'overlays': overlays, 'audio_effects': audio_effects, 'overlay_table': overlay_table, 'keep': keep, 'started': t, 'prepare_seconds': time.time() - t}
+
+
+# Main process side
+
+def _partial_path(output:str):
+    # same extension so ffmpeg still picks the right muxer
+    name, ext = os.path.splitext(output)
+    return f"{name}.partial{ext}"
+
+def render_job(job:dict, prepared:dict) -> float:
+    """ Render a prepared job, with the job's own RENDER_SETTINGS. Returns the seconds it took """
+    from memecat import MemeCat
+    t = time.time()
+    partial = _partial_path(job['output'])
+    effects = dict(overlays=prepared['overlays'], audio_effects=prepared['audio_effects'], overlay_table=prepared['overlay_table'], keep=prepared['keep'])
+    if job.get('preview'):
+        MemeCat.write_preview(
+            job['input'], partial, prepared['ass_path'], **effects,
+            start=job.get('preview_start'), end=job.get('preview_end'), hits=job.get('preview_hits', 6),
+            context=job.get('preview_context', 1.5), height=job.get('preview_height', 360),
+        )
+    else:
+        MemeCat.write(job['input'], partial, prepared['ass_path'], **effects, segments=int(job.get('segments', 1)), render_workers=job.get('render_workers'))
+    os.replace(partial, job['output']) # only completed renders ever appear under the real name
+    return time.time() - t
+
+def run_batch(jobs:list[dict], settings:dict, workers=2, render_workers=None, report_path='batch_report.json', model='small') -> dict:
+    """
+    Run `MemeCat.burn` over many jobs.
+
+    Parameters:
+    - jobs (list[dict]): From `collect_jobs`.
+    - settings (dict): Keyword arguments for `MemeCat.prepare` shared by every job (per job keys override them).
+    - workers (int): Worker processes doing transcription and captions, each with its own warm models.
+    - render_workers (int): Concurrent ffmpeg renders. Defaults to `workers`.
+    - report_path (str): JSON status/timing report, rewritten as each job finishes.
+    - model (str): Whisper model the workers warm up with.
+
+    Returns:
+    - dict: The report.
+    """
+    settings = {k: v for k, v in settings.items() if k not in ('transcript_in', 'transcript_out', 'ass_path')}
+    settings['model'] = model
+    report = {'started': time.time(), 'jobs': []}
+    statuses = []
+    for job in jobs:
+        status = {'input': job['input'], 'output': job['output'], 'status': 'pending'}
+        if os.path.exists(job['output']): # resumable: finished outputs are never redone
+            status['status'] = 'skipped'
+        report['jobs'].append(status)
+        statuses.append(status)
+
+    def save_report():
+        report['updated'] = time.time()
+        if report_path:
+            atomic_write(os.path.abspath(report_path), lambda f: f.write(json.dumps(report, indent=1).encode('utf-8')))
+
+    def fail(status, error):
+        status['status'] = 'failed'
+        status['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+        log.error("FAILED %s: %s", status['input'], status['error'])
+
+    save_report()
+    work_root = tempfile.mkdtemp(prefix='memecat-batch-')
+    context = multiprocessing.get_context('spawn') # torch does not survive fork well
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=warm, initargs=(model,)) as prepare_pool, \
+             ThreadPoolExecutor(max_workers=render_workers or workers) as render_pool:
+            pending, waiting = {}, deque()
+            for i, (job, status) in enumerate(zip(jobs, statuses)):
+                if status['status'] == 'skipped':
+                    continue
+                status['status'] = 'queued'
+                status['queued'] = time.time()
+                waiting.append((i, job, status))
+
+            def start_prepares():
+                # the pool gets no more jobs than it has workers, so every submitted job really is transcribing
+                while waiting and sum(stage == 'prepare' for stage, _, _ in pending.values()) < workers:
+                    i, job, status = waiting.popleft()
+                    work_dir = os.path.join(work_root, str(i))
+                    os.makedirs(work_dir)
+                    job_settings = {**settings, **{k: v for k, v in job.items() if k not in ('input', 'output', *RENDER_SETTINGS)}}
+                    status['status'] = 'transcribing'
+                    pending[prepare_pool.submit(prepare_job, job, job_settings, work_dir)] = ('prepare', job, status)
+
+            start_prepares()
+            save_report()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, job, status = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        fail(status, e)
+                    else:
+                        if stage == 'prepare':
+                            status['queue_seconds'] = result['started'] - status['queued']
+                            status['prepare_seconds'] = result['prepare_seconds']
+                            status['status'] = 'rendering'
+                            pending[render_pool.submit(render_job, job, result)] = ('render', job, status)
+                        else:
+                            status['render_seconds'] = result
+                            status['status'] = 'done'
+                            status['total_seconds'] = time.time() - status['queued']
+                            log.info("DONE %s", job['output'])
+                    start_prepares()
+                    save_report()
+    finally:
+        shutil.rmtree(work_root, ignore_errors=True)
+
+    report['finished'] = time.time()
+    report['summary'] = {s: sum(1 for j in statuses if j['status'] == s) for s in ('done', 'skipped', 'failed')}
+    save_report()
+    return report
@@ -0,0 +1,189 @@
+# On-disk caches shared between MemeCat runs
+# Everything lives under one cache directory (~/.cache/memecat by default, or $MEMECAT_CACHE)
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks on this platform, caches still work for a single process
+    fcntl = None
+
+
+def default_cache_dir():
+    return os.environ.get('MEMECAT_CACHE') or os.path.join(os.path.expanduser('~'), '.cache', 'memecat')
+
+@contextmanager
+def file_lock(path:str, shared=False):
+    """ Hold an advisory lock on `path` (created if missing) for the duration of the block """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def atomic_write(path:str, write):
+    """ Call `write(file)` on a temp file next to `path`, then swap it into place so readers never see a partial file """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class EmbeddingCache:
+    """ Content addressed store of key embeddings, shared by every bucket that uses the same model
+
+    Each model gets its own directory holding `embeddings.npy` (memory-mapped on read) and `index.json`,
+    which maps sha256(model name + key text) to a row of the matrix and the time that row was last used.
+    Writers take an exclusive lock and replace both files atomically, readers take a shared lock.
+    Once more than `max_entries` rows are stored, the least recently used ones are evicted.
+    """
+    def __init__(self, cache_dir=None, max_entries=50000, touch_interval=3600):
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), 'embeddings')
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval # hits only rewrite the index once their timestamp is this stale
+
+    @staticmethod
+    def digest(model_name:str, text:str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _paths(self, model_name:str):
+        folder = os.path.join(self.cache_dir, re.sub(r'[^\w.-]+', '_', model_name))
+        return (os.path.join(folder, 'embeddings.npy'), os.path.join(folder, 'index.json'), os.path.join(folder, '.lock'))
+
+    def _read(self, model_name:str):
+        """ Returns (entries, matrix) as stored on disk, or an empty cache if nothing usable is there """
+        matrix_path, index_path, _ = self._paths(model_name)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)['entries']
+            matrix = np.load(matrix_path, mmap_mode='r')
+            if any(row >= len(matrix) for row, _ in entries.values()):
+                raise ValueError("index points past the end of the matrix")
+            return entries, matrix
+        except (OSError, ValueError, KeyError):
+            return {}, None
+
+    def fetch(self, model_name:str, texts:list[str], embed) -> np.ndarray:
+        """ Embeddings for `texts`, loaded from disk where possible
+
+        Args:
+            model_name (str): Name of the model the embeddings belong to, part of the cache key.
+            texts (list[str]): The texts to embed.
+            embed (Callable[[list[str]], np.ndarray]): Batch embedder, only called with the texts missing from the cache.
+
+        Returns:
+            np.ndarray: One embedding row per text, in order.
+        """
+        _, _, lock_path = self._paths(model_name)
+        digests = [self.digest(model_name, t) for t in texts]
+        found:dict[str, np.ndarray] = {}
+        now = time.time()
+
+        with file_lock(lock_path, shared=True):
+            entries, matrix = self._read(model_name)
+            for d in digests:
+                if d in entries and d not in found:
+                    found[d] = np.array(matrix[entries[d][0]])
+        stale = [d for d in found if now - entries[d][1] > self.touch_interval]
+
+        # only embed what the cache does not know yet, all in one batch
+        missing:dict[str, str] = {}
+        for d, t in zip(digests, texts):
+            if d not in found:
+                missing.setdefault(d, t)
+        if missing:
+            vectors = np.asarray(embed(list(missing.values())), dtype=np.float32)
+            found.update(zip(missing, vectors))
+
+        if missing or stale:
+            self._write(model_name, {d: found[d] for d in missing}, set(found), now)
+        return np.stack([found[d] for d in digests]) if digests else np.empty((0, 0), dtype=np.float32)
+
+    def _write(self, model_name:str, new:dict[str, np.ndarray], used:set[str], now:float):
+        matrix_path, index_path, lock_path = self._paths(model_name)
+        with file_lock(lock_path):
+            # another run may have written since we read, so merge against what is on disk now
+            entries, matrix = self._read(model_name)
+            if matrix is not None and new and next(iter(new.values())).shape != matrix.shape[1:]:
+                entries = {} # the model changed shape under this name, start over
+            rows = {d: matrix[row] for d, (row, _) in entries.items()}
+            stamps = {d: stamp for d, (_, stamp) in entries.items()}
+            rows.update(new)
+            for d in used:
+                if d in rows:
+                    stamps[d] = now
+
+            keep = sorted(rows, key=lambda d: stamps.get(d, now), reverse=True)[:self.max_entries]
+            packed = np.stack([rows[d] for d in keep]).astype(np.float32) if keep else np.empty((0, 0), dtype=np.float32)
+            index = {'model': model_name, 'entries': {d: [i, stamps.get(d, now)] for i, d in enumerate(keep)}}
+
+            atomic_write(matrix_path, lambda f: np.save(f, packed))
+            atomic_write(index_path, lambda f: f.write(json.dumps(index).encode('utf-8')))
+
+
+def audio_fingerprint(path:str) -> str:
+    """ sha256 of the first audio stream's packets, read without decoding. Falls back to the file's bytes """
+    command = ["ffmpeg", "-v", "error", "-i", path, "-map", "0:a:0", "-c", "copy", "-f", "hash", "-hash", "sha256", "-"]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode == 0 and '=' in result.stdout:
+            return result.stdout.strip().split('=', 1)[1]
+    except OSError: # no ffmpeg on the path
+        pass
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    """ Whisper transcripts on disk, keyed by the audio content, the model name and the transcribe options """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), 'transcripts')
+
+    @staticmethod
+    def key(fingerprint:str, model_name:str, options:dict) -> str:
+        spec = json.dumps({'audio': fingerprint, 'model': model_name, 'options': options}, sort_keys=True)
+        return hashlib.sha256(spec.encode('utf-8')).hexdigest()
+
+    def _path(self, key:str):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key:str) -> dict:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key:str, transcript:dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = json.dumps(transcript, default=json_default).encode('utf-8')
+        atomic_write(self._path(key), lambda f: f.write(data))
+
+
+def json_default(o):
+    """ json.dumps fallback for the numpy scalars whisper leaves in its results """
+    if hasattr(o, 'item'):
+        return o.item()
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
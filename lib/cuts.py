@@ -0,0 +1,62 @@
+# Silence removal
+# Pauses between words longer than `min_gap` are cut out. The cut list is a list of (start, end) spans of the
+# original timeline to keep, and the words are moved onto the shorter timeline before any caption is made, so
+# every event, overlay window and volume interval built from them already lines up with the cut video.
+# The render drops everything outside the spans with select/aselect and closes the gaps with setpts/asetpts.
+
+def compact_words(words, keep:list, min_gap=1.0, padding=0.15, duration:float=None):
+    """
+    Yield the (start, end, text) `words` moved onto the cut timeline, from any iterable (streamed words too).
+
+    Every pause longer than `min_gap` seconds is cut, leaving `padding` seconds of it on both sides. The spans of
+    the original timeline that stay are appended to `keep` as they are closed, the last one once the words run out.
+    A short lead-in before the first word is kept, so is a short tail after the last one when `duration` is known.
+    """
+    padding = min(padding, min_gap / 2) # the padding of two words never meets across a cut
+    start = last = None
+    shift = 0.0 # seconds cut before the current span
+    for w_start, w_end, text in words:
+        if start is None:
+            start = shift = max(w_start - padding, 0.0) if w_start > min_gap else 0.0
+        elif w_start - last > min_gap:
+            keep.append((start, last + padding))
+            shift += w_start - padding - (last + padding)
+            start = w_start - padding
+        last = w_end if last is None else max(last, w_end)
+        yield (round(max(w_start - shift, 0.0), 3), round(max(w_end - shift, 0.0), 3), text)
+    if start is not None:
+        end = last + padding
+        if duration is not None:
+            end = duration if duration - last <= min_gap else min(end, duration)
+        keep.append((start, end))
+
+def kept_seconds(keep:list) -> float:
+    return sum(end - start for start, end in keep)
+
+def select_expression(keep:list) -> str:
+    """ `select`/`aselect` expression of t that is true inside the kept spans """
+    return "+".join(f"between(t,{round(start, 6)},{round(end, 6)})" for start, end in keep)
+
+def shift_expression(keep:list) -> str:
+    """
+    Seconds cut before each kept span as a piecewise expression of the input time T, for `setpts`/`asetpts`.
+
+    Every span starts a step of the size of the gap in front of it, so a frame at T in span k moves back by
+    everything cut up to it, the same shift `compact_words` gave the words.
+    """
+    terms, kept, previous = [], 0.0, 0.0
+    for start, end in keep:
+        shift = start - kept
+        if shift - previous > 1e-9:
+            terms.append(f"gte(T,{round(start, 6)})*{round(shift - previous, 6)}")
+        previous = shift
+        kept += end - start
+    return "+".join(terms) or "0"
+
+def cut_filters(keep:list) -> tuple[str, str]:
+    """ (video, audio) filter chains that drop everything outside `keep` and close the gaps """
+    select, shift = select_expression(keep), shift_expression(keep)
+    video = f"select='{select}',setpts='PTS-({shift})/TB'"
+    # audio frames straddle the cuts, aresample pads or trims them to the new timestamps
+    audio = f"aselect='{select}',asetpts='PTS-({shift})/TB',aresample=async=1"
+    return video, audio
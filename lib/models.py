@@ -0,0 +1,46 @@
+# Process wide model registry
+# Heavy libraries (torch, transformers, whisper) are only imported the first time a model is asked for,
+# and every caller in the process shares the same instance of each model after that.
+
+import os
+import threading
+
+from lib.profile import profiler
+
+_lock = threading.Lock()
+_models:dict[tuple[str, str], object] = {}
+
+def _get(kind:str, name:str, load):
+    key = (kind, name)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None: # nobody loaded it while we waited for the lock
+                with profiler.stage(f"load_model:{kind}:{name}"):
+                    model = _models[key] = load()
+    return model
+
+def register(kind:str, name:str, model):
+    """ Put an already built model (or a stand-in with the same interface) into the registry """
+    with _lock:
+        _models[(kind, name)] = model
+
+def loaded() -> list[tuple[str, str]]:
+    """ The (kind, name) of every model loaded so far """
+    return list(_models)
+
+def sentence_transformer(name='paraphrase-MiniLM-L6-v2'):
+    """ The shared SentenceTransformer for `name`, loaded on first use """
+    def load():
+        os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')  # To avoid the SentenceTransformer warning
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(name)
+    return _get('sentence_transformer', name, load)
+
+def whisper(name='small'):
+    """ The shared Whisper model for `name`, loaded on first use """
+    def load():
+        import whisper
+        return whisper.load_model(name)
+    return _get('whisper', name, load)
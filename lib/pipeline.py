@@ -0,0 +1,45 @@
+# Helpers for running pipeline stages concurrently
+
+import queue
+import threading
+
+_DONE = object()
+
+def threaded(iterable, maxsize=8):
+    """ Iterate `iterable` on a background thread, handing items over through a bounded queue
+
+    The producer runs ahead of the consumer by at most `maxsize` items, which bounds memory, and any
+    exception it raises is re-raised in the consumer. Useful when the producer releases the GIL
+    (whisper/torch, ffmpeg) so both sides really run at the same time.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+            items.put(_DONE)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, name='memecat-producer', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # unblock a producer waiting on a full queue so it can notice `stop`
+        while thread.is_alive():
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                thread.join(0.05)
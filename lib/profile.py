@@ -0,0 +1,176 @@
+# Per-stage profiling for a MemeCat run
+# The process wide `profiler` is off by default and costs nothing until `enable()` is called,
+# after which every `stage()` records wall time, CPU time (ours and our children's, e.g. ffmpeg) and the peak RSS
+# reached during the stage, sampled from /proc/self/statm by a background thread while any stage is open.
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def _maxrss_mb(usage) -> float:
+    return usage.ru_maxrss / (1024 * 1024) if sys.platform == 'darwin' else usage.ru_maxrss / 1024 # bytes on macOS, KiB elsewhere
+
+def peak_rss_mb() -> float:
+    """ High-water mark of the whole process so far """
+    return 0.0 if resource is None else _maxrss_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+def rss_mb() -> float:
+    """ Current RSS, None where /proc is not available """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _children_cpu() -> float:
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+class Profiler:
+    SAMPLE_SECONDS = 0.02
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.time()
+        self.stages:list[dict] = []
+        self.counters:dict[str, float] = {}
+        self.data:dict[str, object] = {}
+        self._depth = 0
+        self._open:list[dict] = [] # stages the sampler is measuring
+        self._lock = threading.Lock()
+        self._sampler:threading.Thread = None
+
+    def _sample(self):
+        while True:
+            time.sleep(self.SAMPLE_SECONDS)
+            rss = rss_mb()
+            with self._lock:
+                if not self._open: # the next stage starts a new sampler
+                    self._sampler = None
+                    return
+                for record in self._open:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+
+    @contextmanager
+    def stage(self, name:str):
+        """
+        Record the wall/CPU time of the block, its peak RSS and how much the RSS grew over it. Stages can nest.
+        Yields the record, None when profiling is off.
+        """
+        if not self.enabled:
+            yield None
+            return
+        record = {'stage': name, 'depth': self._depth}
+        self.stages.append(record) # in start order, so nesting reads top to bottom
+        start_rss = rss_mb()
+        if start_rss is not None:
+            record['peak_rss_mb'] = start_rss
+            with self._lock:
+                self._open.append(record)
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+                    self._sampler.start()
+        wall, cpu, children = time.perf_counter(), time.process_time(), _children_cpu()
+        self._depth += 1
+        try:
+            yield record
+        finally:
+            self._depth -= 1
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['child_cpu_seconds'] = _children_cpu() - children
+            if start_rss is None: # no sampling here, the process high-water mark is the best there is
+                record['peak_rss_mb'] = peak_rss_mb()
+            else:
+                end_rss = rss_mb()
+                with self._lock:
+                    self._open.remove(record)
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], end_rss)
+                record['rss_growth_mb'] = end_rss - start_rss
+
+    def count(self, name:str, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name:str, value):
+        """ Attach any other measurement (ffmpeg progress, cache statistics, ...) to the report """
+        if self.enabled:
+            self.data[name] = value
+
+    def report(self) -> dict:
+        return {
+            'started': self.started,
+            'wall_seconds': time.time() - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.stages,
+            'counters': self.counters,
+            **self.data,
+        }
+
+    def save(self, path:str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=1, default=str)
+
+
+profiler = Profiler()
+
+def enable():
+    """ Start profiling this process from now on """
+    profiler.__init__(enabled=True)
+    return profiler
+
+
+def run_ffmpeg(command:list[str], stage='ffmpeg_encode'):
+    """
+    Run an ffmpeg command. While profiling, parse its `-progress` output into fps/speed figures for the report and
+    record its peak RSS. The run is timed as `stage`, None for runs on several threads at once, which nest badly.
+    """
+    import subprocess
+    if not profiler.enabled:
+        subprocess.run(command, check=True)
+        return
+    command = command[:1] + ["-progress", "pipe:1", "-nostats"] + command[1:]
+    progress, fps, peak = {}, [], None
+    with profiler.stage(stage) if stage else nullcontext() as record:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                progress[key] = value
+                if key == 'fps':
+                    try:
+                        fps.append(float(value))
+                    except ValueError:
+                        pass
+            if hasattr(os, 'wait4'): # reap it ourselves for the peak RSS of this ffmpeg alone
+                _, wait_status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(wait_status)
+                peak = _maxrss_mb(usage)
+            elif resource is not None:
+                process.wait()
+                peak = _maxrss_mb(resource.getrusage(resource.RUSAGE_CHILDREN)) # largest child so far
+        if record is not None:
+            record['ffmpeg_peak_rss_mb'] = peak
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    runs = profiler.data.setdefault('ffmpeg', [])
+    runs.append({
+        'stage': stage,
+        'frames': int(progress.get('frame', 0) or 0),
+        'fps_last': fps[-1] if fps else None,
+        'fps_mean': sum(fps) / len(fps) if fps else None,
+        'speed': progress.get('speed'),
+        'out_time': progress.get('out_time'),
+        'peak_rss_mb': peak,
+    })
@@ -2,37 +2,201 @@
 # lks-ai/semdict by Nathaniel D. Gibson
 # This utility class is meant to serve as a quick way to semantically embed and recall any given textual data
 
+import time
 from typing import Any
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from scipy.spatial.distance import cosine
-import os
 
-os.environ['TOKENIZERS_PARALLELISM'] = 'false'  # To avoid the SentenceTransformer warning
+# Initialization of the model takes a moment, so it is loaded on first use and shared through the registry.
+from lib import models
+from lib.ann import make_index
+
+DTYPES = ('float32', 'float16', 'int8')
+
+def normalize_rows(vectors:np.ndarray) -> np.ndarray:
+    """ L2 normalize the last axis so cosine similarity becomes a plain dot product """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0  # zero vectors stay zero instead of becoming NaN
+    return vectors / norms
+
+def quantize(vectors:np.ndarray, dtype:str) -> tuple[np.ndarray, np.ndarray]:
+    """ Store rows as `dtype`. int8 rows come with a float32 scale each (row ~= quantized * scale), other dtypes with None """
+    if dtype != 'int8':
+        return vectors.astype(dtype), None
+    scales = np.abs(vectors).max(axis=-1, keepdims=True) / 127.0
+    scales[scales == 0] = 1.0
+    return np.rint(vectors / scales).astype(np.int8), scales[..., 0].astype(np.float32)
+
+# float16 bits, sign extended and shifted into place, are float32 bits of a number 2**112 too small
+_F16_MASK = np.array(0x8FFFFFFF, dtype=np.uint32).view(np.int32)
+_F16_SCALE = np.float32(2.0 ** 112)
+
+def widen(block:np.ndarray, out:np.ndarray) -> np.ndarray:
+    """ Copy stored rows into the float32 array `out` of the same shape and return it.
+
+    numpy casts float16 one element at a time, this does it with four vectorized integer/float passes instead
+    (exact for every finite value, which is all a normalized embedding holds).
+    """
+    if block.dtype == np.float16:
+        bits = out.view(np.int32)
+        np.copyto(bits, block.view(np.int16)) # sign extends into bits 15 to 31
+        np.left_shift(bits, 13, out=bits)
+        np.bitwise_and(bits, _F16_MASK, out=bits) # keep the sign bit, clear the rest of its copies
+        np.multiply(out, _F16_SCALE, out=out)
+    else:
+        np.copyto(out, block, casting='unsafe')
+    return out
+
+
+class Entry:
+    """ One key of a SemanticDict: its value and the row of its embedding """
+    __slots__ = ('key', 'value', 'row')
+
+    def __init__(self, key:str, value, row:int):
+        self.key = key
+        self.value = value
+        self.row = row
 
-# Initialization of the model takes a moment, so we only initalize it once.
-sentence_transformer = SentenceTransformer('paraphrase-MiniLM-L6-v2')
 
 class SemanticDict:
-    def __init__(self, model_name='paraphrase-MiniLM-L6-v2'):
+    def __init__(self, model_name='paraphrase-MiniLM-L6-v2', cache=None, index='exact', dtype='float32'):
+        """
+        Args:
+            model_name (str, optional): Sentence transformer the keys and queries are embedded with.
+            cache (EmbeddingCache, optional): Where `add_many` looks up and stores key embeddings.
+            index (str, optional): Search backend, see `set_index`.
+            dtype (str, optional): How the key embeddings are stored: 'float32', 'float16' (half the memory)
+                or 'int8' (a quarter, plus one scale per row). Scores stay within about 1e-3 (float16) and 1e-2 (int8)
+                of float32 ones.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"Embedding dtype {dtype} not found, use one of {', '.join(DTYPES)}.")
         self.model_name = model_name
-        self.model = sentence_transformer
-        self.embeddings = {}
-        self.data = {}
+        self._model = None
+        self.cache = cache # optional lib.cache.EmbeddingCache used by add_many
+        # search backend (see lib/ann.py), a name or an index object, rebuilt whenever the keys change
+        self.index = None
+        self.set_index(index)
+        self.dtype = dtype
+        self.entries:dict[str, Entry] = {}
+        # keys[i] is the key stored at row i of the (pre-normalized) embedding matrix
+        self.keys:list[str] = []
+        self._matrix:np.ndarray = None # over-allocated buffer in `dtype`, only the first len(keys) rows are live
+        self._scales:np.ndarray = None # int8 only: the scale of each row of _matrix
+        self.version = 0 # bumped whenever a key is added, re-embedded or removed
+        # running totals of model and search work, for profiling
+        self.stats = {'encode_calls': 0, 'encoded_texts': 0, 'encode_seconds': 0.0, 'search_calls': 0, 'queries': 0, 'search_seconds': 0.0}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key:str):
+        return key in self.entries
+
+    def __getitem__(self, key:str):
+        return self.entries[key].value
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """ Contiguous (len(keys), dim) view of the normalized key embeddings, as stored (see `dtype`) """
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        return self._matrix[:len(self.keys)]
+
+    def vectors(self, rows=None) -> np.ndarray:
+        """ The normalized key embeddings at `rows` (a slice or index array, default all) as float32 """
+        rows = slice(0, len(self.keys)) if rows is None else rows
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        block = self._matrix[rows]
+        vectors = widen(block, np.empty(block.shape, dtype=np.float32))
+        if self._scales is not None:
+            vectors *= self._scales[rows][:, None]
+        return vectors
+
+    def similarity(self, queries:np.ndarray, rows=None, block=512) -> np.ndarray:
+        """ Cosine similarity of normalized `queries` to the keys at `rows` (default all), shape (len(queries), len(rows))
+
+        Compact matrices are widened `block` rows at a time into one float32 buffer that stays in cache, so no full
+        float32 copy is ever made and each block is scored by BLAS right after it is widened. int8 row scales
+        are applied to the scores rather than the rows.
+        """
+        if self._matrix is None:
+            return np.empty((len(queries), 0), dtype=np.float32)
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.dtype == 'float32':
+            return queries @ (self.matrix if rows is None else self._matrix[rows]).T
+        count = len(self.keys) if rows is None else len(rows)
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        buffer = np.empty((min(block, count), self._matrix.shape[1]), dtype=np.float32)
+        for i in range(0, count, block):
+            part = slice(i, min(i + block, count)) if rows is None else rows[i:i + block]
+            scores[:, i:i + block] = queries @ widen(self._matrix[part], buffer[:min(block, count - i)]).T
+            if self._scales is not None:
+                scores[:, i:i + block] *= self._scales[part]
+        return scores
         
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = models.sentence_transformer(self.model_name)
+        return self._model
+
     def __getstate__(self):
         state = self.__dict__.copy()
-        state['model'] = None
+        state['_model'] = None
         return state
     
     def __setstate__(self, state):
         self.__dict__.update(state)
     
     def restore(self):
-        self.model = sentence_transformer
+        self._model = None # picked up again from the registry on next use
+
+    def _encode(self, texts, **kwargs):
+        t = time.perf_counter()
+        embeddings = self.model.encode(texts, **kwargs)
+        self.stats['encode_calls'] += 1
+        self.stats['encoded_texts'] += 1 if isinstance(texts, str) else len(texts)
+        self.stats['encode_seconds'] += time.perf_counter() - t
+        return embeddings
 
     def _embed(self, text):
-        return self.model.encode(text)
+        return self._encode(text)
+
+    def _append_row(self, vector:np.ndarray, scale):
+        size = len(self.keys)
+        if self._matrix is None:
+            self._matrix = np.empty((8, vector.shape[-1]), dtype=self.dtype)
+            self._scales = None if scale is None else np.empty(8, dtype=np.float32)
+        elif size == self._matrix.shape[0]:
+            # grow geometrically so repeated adds stay amortized O(1)
+            grown = np.empty((size * 2, self._matrix.shape[1]), dtype=self.dtype)
+            grown[:size] = self._matrix[:size]
+            self._matrix = grown
+            if self._scales is not None:
+                self._scales = np.concatenate((self._scales[:size], np.empty(size, dtype=np.float32)))
+        self._matrix[size] = vector
+        if scale is not None:
+            self._scales[size] = scale
+
+    def _insert(self, key:str, key_embedding:np.ndarray, value, scale=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self._matrix[entry.row] = key_embedding
+            if scale is not None:
+                self._scales[entry.row] = scale
+            entry.value = value
+        else:
+            self._append_row(key_embedding, scale)
+            self.entries[key] = Entry(key, value, len(self.keys))
+            self.keys.append(key)
+        self.version += 1
+
+    def _insert_many(self, keys:list[str], key_embeddings:np.ndarray, values:list):
+        key_embeddings, scales = quantize(normalize_rows(key_embeddings), self.dtype)
+        for i, (key, value) in enumerate(zip(keys, values)):
+            self._insert(key, key_embeddings[i], value, None if scales is None else scales[i])
 
     def add(self, key:str, value):
         """ Embed a key into the vector store, placing the value as the data for that entry
@@ -41,11 +205,59 @@ class SemanticDict:
             key (str): A textual representation of a semantic key to embed. Used for recall.
             value (Any): The data which is held at the key's embedded vector location.
         """
-        key_embedding = self._embed(key)
-        self.embeddings[key] = key_embedding
-        self.data[key] = value
+        self._insert_many([key], self._embed(key)[None], [value])
+
+    def add_many(self, items, batch_size=64):
+        """ Embed many keys at once, pulling known keys from `self.cache` when one is set
+
+        Args:
+            items (Iterable[tuple[str, Any]]): (key, value) pairs, inserted in order as if by `add`.
+            batch_size (int, optional): How many keys go through the model at once. Defaults to 64.
+        """
+        items = list(items)
+        if not items:
+            return
+        keys = [key for key, _ in items]
+        embed = lambda texts: self._encode(texts, batch_size=batch_size)
+        if self.cache is not None:
+            key_embeddings = self.cache.fetch(self.model_name, keys, embed)
+        else:
+            key_embeddings = embed(keys)
+        self._insert_many(keys, key_embeddings, [value for _, value in items])
+
+    def set_index(self, index='exact', **options):
+        """ Switch the search backend: 'exact', 'ivf' (with lib.ann.IVFIndex options such as nprobe) or an index object """
+        self.index = make_index(index, **options) if isinstance(index, str) else index
+        self._index_version = None # built on the next search, or by build_index
+
+    def build_index(self):
+        """ (Re)build the search index over the current keys. Searches do this themselves when the keys changed """
+        self.index.build(self)
+        self._index_version = self.version
+
+    def _search(self, query_embeddings:np.ndarray, n:int, threshold:float) -> list[list[tuple[str, Any, float]]]:
+        if self._index_version != self.version:
+            self.build_index()
+        t = time.perf_counter()
+        results = [self._closest(distances, n, threshold, rows) for rows, distances in self.index.search(self, query_embeddings)]
+        self._count_search(len(query_embeddings), t)
+        return results
+
+    def _closest(self, distances:np.ndarray, n:int, threshold:float, rows:np.ndarray=None) -> list[tuple[str, Any, float]]:
+        """ Top `n` of a distance vector (over `rows`, or every row) under `threshold`, closest first, as result tuples """
+        # Keep everything under the threshold, then only fully sort the top n of it
+        candidates = np.flatnonzero(distances < threshold)
+        if len(candidates) > n:
+            # keep anything tied with the n-th distance so ties resolve in insertion order, like a stable sort
+            nth = np.partition(distances[candidates], n - 1)[n - 1]
+            candidates = candidates[distances[candidates] <= nth]
+        closest_neighbors = candidates[np.argsort(distances[candidates], kind='stable')][:n]
 
-    def get(self, key, n=1, threshold=0.83) -> tuple[str, Any, float]:
+        # Return the data corresponding to the closest neighbors
+        key_rows = closest_neighbors if rows is None else rows[closest_neighbors]
+        return [(self.keys[r], self.entries[self.keys[r]].value, float(distances[i])) for i, r in zip(closest_neighbors, key_rows)]
+
+    def get(self, key, n=1, threshold=0.83) -> list[tuple[str, Any, float]]:
         """ Get top `n` nearest neighbors to the `key` below `threshold` distance away
 
         Args:
@@ -54,32 +266,57 @@ class SemanticDict:
             threshold (float, optional): The maximum distance a neighboring entry can be from the key embedding. Defaults to 0.83.
 
         Returns:
-            _type_: _description_
+            list[tuple[str, Any, float]]: (key, value, cosine distance) of each neighbor, closest first.
         """
-        key_embedding = self._embed(key)
-        distances = []
-        
-        for stored_key, embedding in self.embeddings.items():
-            distance = cosine(key_embedding, embedding)
-            if distance < threshold:
-                distances.append((stored_key, distance))
-        
-        # Sort by distance and return the top n closest neighbors
-        distances.sort(key=lambda x: x[1])
-        closest_neighbors = distances[:n]
+        if not self.keys or n < 1:
+            return []
+        key_embedding = normalize_rows(self._embed(key))
+        return self._search(key_embedding[None], n, threshold)[0]
 
-        # Return the data corresponding to the closest neighbors
-        return [(stored_key, self.data[stored_key], _) for stored_key, _ in closest_neighbors]
+    def get_many(self, keys:list[str], n=1, threshold=0.83, batch_size=64) -> list[list[tuple[str, Any, float]]]:
+        """ Batched `get`: embed the queries `batch_size` at a time and score each batch in one matrix product
+
+        Args:
+            keys (list[str]): The queries to search the vectorstore by.
+            n (int, optional): Maximum number of results per query. Defaults to 1.
+            threshold (float, optional): The maximum distance a neighboring entry can be from a query embedding. Defaults to 0.83.
+            batch_size (int, optional): How many queries go through the model (and the matrix product) at once. Defaults to 64.
+
+        Returns:
+            list[list[tuple[str, Any, float]]]: One `get` style result list per query, in query order.
+        """
+        if not self.keys or n < 1:
+            return [[] for _ in keys]
+        results = []
+        for i in range(0, len(keys), batch_size):
+            batch = list(keys[i:i + batch_size])
+            query_embeddings = normalize_rows(self._encode(batch, batch_size=batch_size))
+            results.extend(self._search(query_embeddings, n, threshold))
+        return results
+
+    def _count_search(self, queries:int, started:float):
+        self.stats['search_calls'] += 1
+        self.stats['queries'] += queries
+        self.stats['search_seconds'] += time.perf_counter() - started
     
     def remove(self, key:str):
-        key_embedding = self._embed(key)
-        return self.data.pop(key_embedding)
+        """ Remove a key and its embedding, returning the value that was stored there """
+        entry = self.entries.pop(key)
+        row, size = entry.row, len(self.keys)
+        # shift the following rows up so the matrix stays contiguous and in insertion order
+        self._matrix[row:size - 1] = self._matrix[row + 1:size]
+        if self._scales is not None:
+            self._scales[row:size - 1] = self._scales[row + 1:size]
+        del self.keys[row]
+        for i in range(row, size - 1):
+            self.entries[self.keys[i]].row = i
+        self.version += 1
+        return entry.value
         
         
 if __name__ == "__main__":
 
     # test utility function to measure elapsed time in steps
-    import time
     last = time.time()
     def elapsed(tag):
         global last
@@ -92,7 +329,8 @@ if __name__ == "__main__":
     # Initialize and add some data into the dict
     elapsed('start')
     sed = SemanticDict()
-    elapsed('post model init') # shows time for class init as model init is already done
+    sed.model # the model is loaded lazily, force it here so the adds below are timed on their own
+    elapsed('post model init')
     sed.add("eat apple", {'action': {'type': 'eat', 'target': 'apple'}})
     elapsed('add apple')
     sed.add("take car", {'action': {'type': 'take', 'target': 'car'}})
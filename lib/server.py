@@ -0,0 +1,324 @@
+# Render server
+# A long running version of batch mode (lib/batch.py) for frontends that would otherwise start memecat.py per upload:
+# the prepare workers keep whisper and the embedder loaded and reuse compiled buckets until their yaml changes,
+# and jobs arrive over a small JSON API on a local TCP port or Unix socket.
+#
+#   POST /jobs       {"input": ..., "output": ..., any MemeCat.prepare keyword}  -> 202 with the job, 400 for a setting
+#                    it cannot take, 503 when the queue is full ("bucket" is taken for "bucket_path", like the command
+#                    line's --bucket, and the render settings of batch manifests work too)
+#   GET  /jobs/<id>  status and timings of a job
+#   GET  /metrics    queue depth, running jobs, counters and latency percentiles per stage
+#   GET  /health     {"ok": true}
+
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socketserver
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from lib import models
+from lib.batch import RENDER_SETTINGS, check_job, prepare_job, render_job, warm
+
+log = logging.getLogger('memecat.server')
+
+STAGES = ('queue', 'prepare', 'render_queue', 'render', 'total')
+# settings the server manages itself, a job cannot override them
+RESERVED = ('model', 'bucket', 'keep', 'ass_path', 'transcript_in', 'transcript_out')
+
+
+class QueueFull(Exception):
+    pass
+
+
+def latency_summary(seconds) -> dict:
+    """ count, mean, p50, p95 and max of a list of durations """
+    if not seconds:
+        return {'count': 0}
+    s = np.asarray(seconds, dtype=np.float64)
+    p50, p95 = np.percentile(s, [50, 95])
+    return {'count': len(s), 'mean': float(s.mean()), 'p50': float(p50), 'p95': float(p95), 'max': float(s.max())}
+
+
+def _init_worker(model:str, stub:bool):
+    # Ctrl+C is for the server, which then lets the workers finish their jobs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm(model, stub)
+
+
+class RenderServer:
+    """
+    Runs `MemeCat.burn` jobs on warm worker pools.
+
+    Parameters:
+    - settings (dict): Keyword arguments for `MemeCat.prepare` shared by every job (a job's own keys override them).
+    - model (str): Whisper model every prepare worker loads once.
+    - asr_workers (int): Worker processes transcribing and writing captions, each with its own models and buckets.
+    - render_workers (int): Concurrent ffmpeg renders.
+    - max_queue (int): Most jobs accepted and not finished yet, further jobs are refused until one finishes.
+    - stub (bool): Use the offline stand-in models of lib/stubs.py, for local testing. Caches are turned off
+        so their results never mix with the real models'.
+    - history (int): Finished jobs kept for status requests.
+    - latency_window (int): Latest jobs the latency figures are computed over.
+    """
+    def __init__(self, settings:dict, model='small', asr_workers=1, render_workers=2, max_queue=32, stub=False, history=1000, latency_window=1000):
+        settings = {k: v for k, v in settings.items() if k not in RESERVED}
+        if stub: # stand-ins only run in-process, so no parallel transcription either
+            model = 'stub'
+            settings.update(embedding_cache=False, transcript_cache=False, transcribe_workers=1)
+        settings['model'] = model
+        self.settings = settings
+        self.asr_workers = asr_workers
+        self.render_workers = render_workers
+        self.max_queue = max_queue
+        self.history = history
+        self.jobs:OrderedDict[str, dict] = OrderedDict()
+        self.counters = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0}
+        self.latency = {stage: deque(maxlen=latency_window) for stage in STAGES}
+        self._futures = {}
+        self._active = 0
+        # jobs reach the prepare pool only once a worker is free, a process pool marks one job too many as running
+        self._waiting = deque()
+        self._preparing = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.started = time.time()
+        self.work_root = tempfile.mkdtemp(prefix='memecat-server-')
+        context = multiprocessing.get_context('spawn') # torch does not survive fork well
+        self.prepare_pool = ProcessPoolExecutor(max_workers=asr_workers, mp_context=context, initializer=_init_worker, initargs=(model, stub))
+        self.render_pool = ThreadPoolExecutor(max_workers=render_workers)
+
+    def warm_up(self):
+        """ Start every prepare worker and wait until their models are loaded """
+        t = time.time()
+        futures = [self.prepare_pool.submit(models.loaded) for _ in range(self.asr_workers)]
+        wait(futures)
+        log.info("Workers ready in %.1fs with %s", time.time() - t, futures[0].result())
+
+    def submit(self, job:dict) -> dict:
+        """ Queue a job: `input`, `output` and any `MemeCat.prepare` keywords to override. Returns its status """
+        if not isinstance(job, dict) or not job.get('input') or not job.get('output'):
+            raise ValueError("A job needs an input and an output.")
+        if 'bucket' in job: # the yaml path, named after --bucket; the loaded bucket is the server's business
+            if 'bucket_path' in job:
+                raise ValueError("Set bucket or bucket_path, not both.")
+            job = dict(job)
+            job['bucket_path'] = job.pop('bucket')
+        if not os.path.isfile(job['input']):
+            raise ValueError(f"Input {job['input']} not found.")
+        reserved = [k for k in job if k in RESERVED]
+        if reserved:
+            raise ValueError(f"Jobs cannot set {', '.join(reserved)}.")
+        check_job(job)
+        with self._lock:
+            if self._active >= self.max_queue:
+                self.counters['rejected'] += 1
+                raise QueueFull(f"{self._active} jobs are already queued or running.")
+            self._active += 1
+            self.counters['submitted'] += 1
+            job_id = uuid.uuid4().hex[:12]
+            status = self.jobs[job_id] = {'id': job_id, 'input': job['input'], 'output': job['output'], 'status': 'queued', 'submitted': time.time()}
+        work_dir = os.path.join(self.work_root, job_id)
+        os.makedirs(work_dir)
+        render = {k: v for k, v in job.items() if k in ('input', 'output', *RENDER_SETTINGS)}
+        job_settings = {**self.settings, **{k: v for k, v in job.items() if k not in render}}
+        with self._lock:
+            self._waiting.append((status, render, job_settings, work_dir))
+            queued = dict(status)
+        log.info("QUEUED %s %s", job_id, job['input'])
+        self._start_prepares()
+        return queued
+
+    def _start_prepares(self):
+        """ Hand waiting jobs to the prepare pool while it has idle workers """
+        started = []
+        with self._lock:
+            while self._waiting and self._preparing < self.asr_workers:
+                status, render, job_settings, work_dir = self._waiting.popleft()
+                self._preparing += 1
+                status['status'] = 'transcribing'
+                started.append((status, render, job_settings, work_dir))
+        # callbacks of futures that are already done run right away, so they are added outside the lock
+        for status, render, job_settings, work_dir in started:
+            try:
+                future = self._futures[status['id']] = self.prepare_pool.submit(prepare_job, render, job_settings, work_dir)
+            except Exception as e: # the pool is shutting down
+                self._release()
+                self._finish(status, work_dir, error=e)
+                continue
+            future.add_done_callback(lambda f, status=status, render=render, work_dir=work_dir: self._prepared(status, render, work_dir, f))
+
+    def _release(self):
+        with self._lock:
+            self._preparing -= 1
+            self._idle.notify_all()
+
+    def _prepared(self, status:dict, render:dict, work_dir:str, future):
+        self._release()
+        self._start_prepares()
+        try:
+            prepared = future.result()
+        except Exception as e:
+            return self._finish(status, work_dir, error=e)
+        now = time.time()
+        with self._lock:
+            status['prepare_seconds'] = prepared['prepare_seconds']
+            status['queue_seconds'] = prepared['started'] - status['submitted']
+            status['prepared'] = now
+            status['status'] = 'rendering'
+        try:
+            future = self._futures[status['id']] = self.render_pool.submit(render_job, render, prepared)
+        except Exception as e:
+            return self._finish(status, work_dir, error=e)
+        future.add_done_callback(lambda f: self._rendered(status, work_dir, f))
+
+    def _rendered(self, status:dict, work_dir:str, future):
+        try:
+            render_seconds = future.result()
+        except Exception as e:
+            return self._finish(status, work_dir, error=e)
+        with self._lock:
+            status['render_seconds'] = render_seconds
+            status['render_queue_seconds'] = time.time() - status.pop('prepared') - render_seconds
+        self._finish(status, work_dir)
+
+    def _finish(self, status:dict, work_dir:str, error:Exception=None):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with self._lock:
+            self._futures.pop(status['id'], None)
+            self._active -= 1
+            status['finished'] = time.time()
+            status['total_seconds'] = status['finished'] - status['submitted']
+            status.pop('prepared', None)
+            if error is None:
+                status['status'] = 'done'
+                self.counters['done'] += 1
+                for stage in STAGES:
+                    self.latency[stage].append(status[f"{stage}_seconds"])
+            else:
+                status['status'] = 'failed'
+                status['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+                self.counters['failed'] += 1
+            # forget the oldest finished jobs
+            finished = [job_id for job_id, s in self.jobs.items() if 'finished' in s]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job_id]
+        if error is None:
+            log.info("DONE %s %s in %.2fs", status['id'], status['output'], status['total_seconds'])
+        else:
+            log.error("FAILED %s %s: %s", status['id'], status['input'], status['error'])
+
+    def _state(self, status:dict) -> str:
+        # rendering jobs may still be waiting for a free render thread
+        future = self._futures.get(status['id'])
+        if status['status'] == 'rendering' and not (future is not None and future.running()):
+            return 'render_queued'
+        return status['status']
+
+    def status(self, job_id:str) -> dict:
+        """ A copy of the job's status, None if it is unknown (or long finished) """
+        with self._lock:
+            status = self.jobs.get(job_id)
+            return None if status is None else dict(status, status=self._state(status))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            states = Counter(self._state(s) for s in self.jobs.values() if 'finished' not in s)
+            return {
+                'uptime_seconds': time.time() - self.started,
+                'queue_depth': states['queued'] + states['render_queued'],
+                'jobs': {state: states[state] for state in ('queued', 'transcribing', 'render_queued', 'rendering')},
+                'active': self._active,
+                'max_queue': self.max_queue,
+                'workers': {'asr': self.asr_workers, 'render': self.render_workers},
+                **self.counters,
+                'latency_seconds': {stage: latency_summary(self.latency[stage]) for stage in STAGES},
+            }
+
+    def close(self):
+        """ Finish the accepted jobs, then stop the workers """
+        with self._idle: # waiting jobs still have to be handed to the pool
+            self._idle.wait_for(lambda: not self._waiting and not self._preparing)
+        self.prepare_pool.shutdown(wait=True)
+        self.render_pool.shutdown(wait=True)
+        shutil.rmtree(self.work_root, ignore_errors=True)
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'memecat'
+
+    def reply(self, code:int, body:dict):
+        data = json.dumps(body, indent=1).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        render:RenderServer = self.server.render
+        if self.path == '/health':
+            self.reply(200, {'ok': True})
+        elif self.path == '/metrics':
+            self.reply(200, render.metrics())
+        elif self.path.startswith('/jobs/'):
+            status = render.status(self.path[len('/jobs/'):])
+            if status is None:
+                self.reply(404, {'error': "Job not found."})
+            else:
+                self.reply(200, status)
+        else:
+            self.reply(404, {'error': f"No route {self.path}."})
+
+    def do_POST(self):
+        render:RenderServer = self.server.render
+        if self.path != '/jobs':
+            return self.reply(404, {'error': f"No route {self.path}."})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self.reply(202, render.submit(job))
+        except QueueFull as e:
+            self.reply(503, {'error': str(e)})
+        except ValueError as e: # bad JSON included
+            self.reply(400, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        # the default writes to stderr and needs a TCP client address
+        log.debug("%s %s", self.command, format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(render:RenderServer, host='127.0.0.1', port=8765, socket_path:str=None):
+    """ Answer the API on `host`:`port`, or on the Unix socket `socket_path`, until interrupted """
+    if socket_path is not None:
+        if os.path.exists(socket_path): # left over from an earlier run
+            os.remove(socket_path)
+        httpd, where = UnixHTTPServer(socket_path, Handler), socket_path
+    else:
+        httpd, where = ThreadingHTTPServer((host, port), Handler), f"http://{host}:{port}"
+    httpd.render = render
+    render.warm_up()
+    log.info("Serving on %s", where)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        render.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,91 @@
+# Offline stand-ins for the heavy models, for benchmarks and local testing
+# They have the same interface as the real thing but need no download and give the same output on every machine.
+
+import zlib
+
+import numpy as np
+
+from lib import models
+from lib.audio import frame_energy_db, load_audio
+
+
+class HashEmbedder:
+    """ A SentenceTransformer look-alike: every word gets a fixed pseudo random vector and a text is the sum of its words
+
+    Texts sharing words land close together, which is enough for searches to behave like the real model's
+    (hits, misses, thresholds) without any of its cost. `dim` matches paraphrase-MiniLM-L6-v2.
+    """
+    def __init__(self, dim=384):
+        self.dim = dim
+        self._words:dict[str, np.ndarray] = {}
+
+    def _word(self, word:str) -> np.ndarray:
+        v = self._words.get(word)
+        if v is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode('utf-8')))
+            v = self._words[word] = rng.standard_normal(self.dim).astype(np.float32)
+        return v
+
+    def _one(self, text:str) -> np.ndarray:
+        v = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            v += self._word(word)
+        return v
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self._one(sentences)
+        if len(sentences) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._one(text) for text in sentences])
+
+
+def use_stub_embedder(name='paraphrase-MiniLM-L6-v2', dim=384) -> HashEmbedder:
+    """ Serve `HashEmbedder` wherever the sentence transformer `name` is asked for in this process """
+    embedder = HashEmbedder(dim)
+    models.register('sentence_transformer', name, embedder)
+    return embedder
+
+
+class StubWhisper:
+    """ A whisper model look-alike: every stretch of sound in the audio becomes a run of made up words
+
+    Sound is any 20 ms frame within 20 dB of the loudest one, so words line up with the speech and the pauses
+    like a real transcript's would, about `word_seconds` each. Their text cycles through `vocabulary`.
+    """
+    VOCABULARY = ('hello', 'war', 'money', 'progress', 'technology', 'poverty', 'code', 'prompt', 'wrong', 'something')
+
+    def __init__(self, vocabulary=VOCABULARY, word_seconds=0.4):
+        self.vocabulary = vocabulary
+        self.word_seconds = word_seconds
+
+    def transcribe(self, audio, word_timestamps=True, **options) -> dict:
+        if isinstance(audio, str):
+            audio = load_audio(audio)
+        frame_ms = 20
+        energy = frame_energy_db(audio, frame_ms=frame_ms)
+        voiced = (energy > max(energy.max(initial=-200.0) - 20.0, -80.0)).astype(np.int8)
+        edges = np.diff(np.concatenate(([0], voiced, [0])))
+        segments, count = [], 0
+        for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            start, end = int(first) * frame_ms / 1000, int(last) * frame_ms / 1000
+            n = max(1, round((end - start) / self.word_seconds))
+            step = (end - start) / n
+            words = []
+            for i in range(n):
+                words.append({'word': ' ' + self.vocabulary[count % len(self.vocabulary)], 'start': round(start + i * step, 2), 'end': round(start + (i + 1) * step, 2), 'probability': 1.0})
+                count += 1
+            segments.append({'id': len(segments), 'start': round(start, 2), 'end': round(end, 2), 'text': ''.join(w['word'] for w in words), 'words': words})
+        return {'text': ''.join(s['text'] for s in segments), 'segments': segments, 'language': 'en'}
+
+
+def use_stub_whisper(name='stub') -> StubWhisper:
+    """ Serve `StubWhisper` wherever the whisper model `name` is asked for in this process """
+    model = StubWhisper()
+    models.register('whisper', name, model)
+    return model
+
+def use_stub_models(whisper_name='stub', embedder_name='paraphrase-MiniLM-L6-v2'):
+    """ Both stand-ins at once. Keep caches off while they are in use, their results are stored under these names """
+    use_stub_whisper(whisper_name)
+    use_stub_embedder(embedder_name)
@@ -0,0 +1,41 @@
+# Bounded frequent-item counting (space-saving algorithm)
+# Memory stays at `capacity` counters however long the stream is, and any item seen more than
+# total / capacity times is guaranteed to be among them, with a count at most that much too high.
+
+class TopK:
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts:dict[str, int] = {}
+        self.total = 0
+        # counters at the smallest count, oldest first, collected in one pass and used up across evictions
+        self._smallest:list[str] = []
+        self._smallest_count = 0
+
+    def add(self, item:str):
+        self.total += 1
+        count = self.counts.get(item)
+        if count is not None:
+            self.counts[item] = count + 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = 1
+        else: # take over a smallest counter, inheriting its count as the error bound
+            victim = self._pop_smallest()
+            del self.counts[victim]
+            self.counts[item] = self._smallest_count + 1
+
+    def _pop_smallest(self) -> str:
+        while self._smallest:
+            victim = self._smallest.pop()
+            if self.counts.get(victim) == self._smallest_count: # not counted up since it was collected
+                return victim
+        self._smallest_count = min(self.counts.values())
+        self._smallest = [item for item, count in self.counts.items() if count == self._smallest_count][::-1]
+        return self._smallest.pop()
+
+    def most_common(self, n=None) -> list[tuple[str, int]]:
+        """ (item, count) pairs, highest count first (first counted first among equal counts) """
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return ranked if n is None else ranked[:n]
+
+    def __len__(self):
+        return len(self.counts)
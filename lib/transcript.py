@@ -0,0 +1,60 @@
+# Transcript helpers
+# A transcript is a plain dict so it can round trip through JSON:
+#   {'model': str, 'language': str, 'segments': [{'start', 'end', 'text', 'words': [{'word', 'start', 'end'}, ...]}, ...],
+#    'words': [[start, end, text], ...]}
+
+import json
+
+from lib.cache import json_default
+
+SEGMENT_FIELDS = ('id', 'start', 'end', 'text', 'words')
+
+def words_from_segments(segments:list[dict]) -> list[tuple[float, float, str]]:
+    """ Flatten whisper segments into (start, end, text) word tuples """
+    # Extract words and their timestamps
+    word_list = []
+    for seg in segments:
+        for w in seg.get('words', []):
+            w_text = w['word'].strip()
+            if w_text:
+                start = w['start']
+                end = w['end']
+                word_list.append((start, end, w_text))
+
+    # Fallback if no word-level timestamps
+    if not word_list:
+        for seg in segments:
+            word_list.append((seg['start'], seg['end'], seg['text'].strip()))
+    return word_list
+
+def from_whisper(result:dict, model_name:str) -> dict:
+    """ Keep the parts of a whisper `transcribe` result that captions are built from """
+    segments = []
+    for seg in result['segments']:
+        segment = {k: seg[k] for k in SEGMENT_FIELDS if k in seg}
+        segment['words'] = [{'word': w['word'], 'start': w['start'], 'end': w['end']} for w in seg.get('words', [])]
+        segments.append(segment)
+    return {
+        'model': model_name,
+        'language': result.get('language'),
+        'segments': segments,
+        'words': [list(w) for w in words_from_segments(segments)],
+    }
+
+def word_list(transcript:dict) -> list[tuple[float, float, str]]:
+    """ The (start, end, text) word tuples of a transcript, rebuilt from its segments if `words` is missing """
+    if transcript.get('words'):
+        return [(float(start), float(end), str(text)) for start, end, text in transcript['words']]
+    return words_from_segments(transcript.get('segments', []))
+
+def save(transcript:dict, path:str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(transcript, f, indent=1, ensure_ascii=False, default=json_default)
+
+def load(path:str) -> dict:
+    """ Read a transcript written by `save`. Hand edits to `words` win over `segments` """
+    with open(path, 'r', encoding='utf-8') as f:
+        transcript = json.load(f)
+    if isinstance(transcript, list): # a bare word list
+        transcript = {'words': transcript}
+    return transcript
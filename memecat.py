@@ -1,12 +1,38 @@
 import argparse
-import copy
+import ast
+import inspect
+import io
+import itertools
+import logging
+import operator
 import os
+import re
 import subprocess
 import tempfile
-import whisper
+import time
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 
 import yaml
-from lib.semdict import SemanticDict
+from lib import models, profile
+from lib.asr import transcribe_parallel, transcribe_stream
+from lib.audio import SAMPLE_RATE, load_audio
+from lib.cuts import compact_words, cut_filters, kept_seconds, select_expression, shift_expression
+from lib.cache import EmbeddingCache, TranscriptCache, audio_fingerprint
+from lib.ann import INDEXES
+from lib.lru import LRUCache
+from lib.pipeline import threaded
+from lib.profile import profiler, run_ffmpeg
+from lib.transcript import from_whisper as transcript_from_whisper, load as load_transcript, save as save_transcript, word_list as transcript_words
+from lib.semdict import DTYPES, SemanticDict
+from lib.topk import TopK
+
+log = logging.getLogger('memecat') # quiet unless main (or the caller) turns it up
+
+# encoder settings for previews: speed over size and quality
+PREVIEW_OPTIONS = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "30"]
 
 """
     MemeCat: smart subtitles, less work. By @newsbubbles on github (@natecodesai on YouTube)
@@ -25,6 +51,226 @@ def rgb_mirror(color):
     # b g r <-|-> r g b
     return color[4:6] + color[2:4] + color[0:2]
 
+def merge_windows(windows):
+    """ Sort (start, end) windows and merge the ones that overlap or touch """
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(w) for w in merged]
+
+def volume_spans(audio_effects:list[dict]) -> list[tuple[float, bool, float, bool, float]]:
+    """
+    Disjoint (start, start inclusive, end, end inclusive, volume) spans of the combined volume of the hits.
+
+    Overlapping hits multiply, the same as a chain of `volume=enable='between(...)'` filters would. One sweep
+    over the sorted starts and ends keeps a count of the active hits per volume, so the product at every
+    breakpoint costs the number of distinct volumes rather than the number of hits. Neighbouring pieces with
+    the same volume are merged.
+    """
+    starts, ends = defaultdict(list), defaultdict(list)
+    for af in audio_effects:
+        start, end, volume = float(af['start']), float(af['end']), float(af['volume'])
+        if start <= end:
+            starts[start].append(volume)
+            ends[end].append(volume)
+    active = Counter()
+    def product():
+        value = 1.0
+        for volume in sorted(active):
+            value *= volume ** active[volume]
+        return value
+
+    # alternate between each breakpoint (between() includes both ends) and the open stretch after it
+    spans = []
+    def add(piece):
+        if spans and spans[-1][4] == piece[4]:
+            spans[-1] = spans[-1][:2] + piece[2:]
+        else:
+            spans.append(piece)
+    points = sorted(starts.keys() | ends.keys())
+    for i, p in enumerate(points):
+        active.update(starts[p])
+        add((p, True, p, True, product()))
+        active.subtract(ends[p])
+        active += Counter() # drop the volumes no hit holds any more
+        if i + 1 < len(points):
+            add((p, False, points[i + 1], False, product()))
+    return spans
+
+def volume_expression(audio_effects:list[dict]) -> str:
+    """
+    Collapse volume effect hits into one piecewise `volume` expression of t: the `volume_spans` summed as
+    `1 + span*(volume-1)` terms, so the output matches the old filter chain. None when nothing changes the volume.
+    """
+    terms = []
+    for start, start_inclusive, end, end_inclusive, volume in volume_spans(audio_effects):
+        if volume != 1.0:
+            terms.append(f"{'gte' if start_inclusive else 'gt'}(t,{start})*{'lte' if end_inclusive else 'lt'}(t,{end})*({volume - 1.0})")
+    if not terms:
+        return None
+    return "1+" + "+".join(terms)
+
+# longest volume expression put on the command line: one argument may hold 128 KiB on Linux, a whole command 32 KiB on Windows
+VOLUME_EXPRESSION_LIMIT = 8192
+
+def volume_filter(audio_effects:list[dict], commands_path:str, name='hits') -> str:
+    """
+    The audio filter applying the volume hits, None when there are none. Usually one `volume` expression,
+    evaluated per audio frame. An expression longer than VOLUME_EXPRESSION_LIMIT would not fit on the command
+    line (long runs with --words 1 get there), so the spans go to an `asendcmd` script at `commands_path`
+    instead, which sets the `volume@name` filter as each span starts and resets it when it ends.
+    """
+    expression = volume_expression(audio_effects)
+    if expression is None:
+        return None
+    if len(expression) <= VOLUME_EXPRESSION_LIMIT:
+        return f"volume=volume='{expression}':eval=frame"
+    with open(commands_path, 'w', encoding='utf-8') as f:
+        for start, _, end, _, volume in volume_spans(audio_effects):
+            if volume != 1.0 and end > start: # a single instant never holds a frame
+                f.write(f"{start:.6f}-{end:.6f} [enter] volume@{name} volume {volume}, [leave] volume@{name} volume 1;\n")
+    return f"asendcmd=f='{commands_path}',volume@{name}=volume=1"
+
+def scale_length(value, factor):
+    """
+    A pixel length or position times `factor`: numbers, and expressions of the input size (iw, ih) as used by `scale`.
+    Negative numbers (scale's keep the aspect ratio) and expressions of the frame size (main_w) are left alone.
+    """
+    if factor == 1.0:
+        return value
+    if isinstance(value, (int, float)):
+        return value if value < 0 else round(value * factor)
+    if re.fullmatch(r"[\d. ]+", str(value)) or re.search(r"\b(iw|ih)\b", str(value)):
+        return f"({value})*{factor}"
+    return value
+
+def parse_size(size) -> tuple[int, int]:
+    """ 'WIDTHxHEIGHT' (or a [width, height] pair) as two ints """
+    width, height = size.lower().split('x') if isinstance(size, str) else size
+    return int(width), int(height)
+
+# keys of a `burn_variants` variant besides the `prepare` settings it overrides
+VARIANT_KEYS = ('output', 'size', 'crop', 'captions')
+# `prepare` parameters every variant shares: the transcription, and what `burn_variants` fills in itself
+SHARED_SETTINGS = ('input_video', 'model', 'transcript_cache', 'transcript_in', 'transcript_out', 'transcribe_workers', 'chunk_seconds', 'stream', 'ass_path', 'play_res', 'bucket', 'transcript', 'keep')
+
+def variant_filter(size=None, crop=None) -> str:
+    """ Video filters for an output variant: `crop` (crop filter arguments), then fill and center crop to `size` """
+    filters = []
+    if crop:
+        filters.append(f"crop={crop}")
+    if size:
+        width, height = parse_size(size)
+        filters.append(f"scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height}")
+    return ",".join(filters) or None
+
+CROP_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv, ast.Mod: operator.mod}
+
+def _crop_expression(expression:str, names:dict) -> float:
+    """ Value of a crop size expression: numbers, + - * / %, min/max and the names in `names` """
+    def value(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in names:
+            return names[node.id]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            return value(node.operand) if isinstance(node.op, ast.UAdd) else -value(node.operand)
+        if isinstance(node, ast.BinOp) and type(node.op) in CROP_OPERATORS:
+            return CROP_OPERATORS[type(node.op)](value(node.left), value(node.right))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('min', 'max') and not node.keywords:
+            return (min if node.func.id == 'min' else max)(value(a) for a in node.args)
+        raise ValueError(f"Cannot work out the crop size {expression!r}: only numbers, + - * / %, min, max, iw, ih, ow, oh and a are understood.")
+    try:
+        return value(ast.parse(expression.replace("\\,", ","), mode='eval').body)
+    except SyntaxError:
+        raise ValueError(f"Cannot work out the crop size {expression!r}.") from None
+
+def crop_size(crop:str, input_size:tuple[int, int]) -> tuple[int, int]:
+    """ (width, height) the crop filter with arguments `crop` (positional w:h:x:y or w=...:h=...) makes of an `input_size` frame """
+    options = {}
+    for i, part in enumerate(crop.split(':')):
+        key, eq, value = part.partition('=')
+        if not eq: # positional
+            key, value = ('w', 'h', 'x', 'y')[i] if i < 4 else str(i), part
+        key = {'out_w': 'w', 'out_h': 'h'}.get(key.strip(), key.strip())
+        options[key] = value.strip().strip("'\"")
+    width, height = input_size
+    names = {'iw': width, 'in_w': width, 'ih': height, 'in_h': height, 'a': width / height}
+    w, h = options.get('w', 'iw'), options.get('h', 'ih')
+    # either size may refer to the other (ow, oh), ffmpeg works the width out first
+    try:
+        out_w = _crop_expression(w, names)
+        out_h = _crop_expression(h, dict(names, ow=out_w, out_w=out_w))
+    except ValueError:
+        out_h = _crop_expression(h, names)
+        out_w = _crop_expression(w, dict(names, oh=out_h, out_h=out_h))
+    return int(out_w), int(out_h)
+
+def variant_play_res(size=None, crop:str=None, input_size:tuple[int, int]=None) -> tuple[int, int]:
+    """
+    ASS coordinate space for an output variant: 1080 high with the output's aspect ratio, so captions keep their
+    proportions. The output is `size`, or the `crop` of an `input_size` frame without one.
+    """
+    if size:
+        width, height = parse_size(size)
+    elif crop:
+        width, height = crop_size(crop, input_size)
+    else:
+        return (1920, 1080)
+    return (round(1080 * width / height), 1080)
+
+def parse_ass_time(stamp:str) -> float:
+    """ H:MM:SS.cc back to float seconds """
+    h, m, sec = stamp.strip().split(':')
+    return int(h) * 3600 + int(m) * 60 + float(sec)
+
+def prune_ass(ass_content:str, start:float, end:float) -> str:
+    """ Keep the header and only the Dialogue events that are on screen somewhere in [start, end] """
+    lines = []
+    for line in ass_content.split("\n"):
+        if line.startswith("Dialogue:"):
+            fields = line.split(",", 3)
+            if parse_ass_time(fields[2]) < start or parse_ass_time(fields[1]) > end:
+                continue
+        lines.append(line)
+    return "\n".join(lines)
+
+def probe_duration(video_path:str) -> float:
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", video_path]
+    return float(subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip())
+
+def probe_start_time(video_path:str) -> float:
+    """ Where the file's timeline starts, non zero for MPEG-TS or MP4s with an edit list. -ss and pts_time are measured differently because of it """
+    command = ["ffprobe", "-v", "error", "-show_entries", "format=start_time", "-of", "csv=p=0", video_path]
+    start = subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip()
+    return 0.0 if start in ('', 'N/A') else float(start)
+
+def probe_size(video_path:str) -> tuple[int, int]:
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", video_path]
+    width, height = subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip().split(',')
+    return int(width), int(height)
+
+def probe_height(video_path:str) -> int:
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=height", "-of", "csv=p=0", video_path]
+    return int(subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip())
+
+def probe_keyframes(video_path:str) -> list[float]:
+    """ Timestamps of the video keyframes, read from the packet flags so nothing is decoded
+
+    These are absolute pts times, subtract `probe_start_time` to get positions for -ss.
+    """
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video_path]
+    out = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    times = []
+    for line in out.splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' in flags and pts not in ('', 'N/A'):
+            times.append(float(pts))
+    return sorted(times)
+
 def seconds_to_hms(seconds):
     """Convert float seconds to H,MM,SS.xx format."""
     h = int(seconds // 3600)
@@ -43,22 +289,44 @@ class Style: # a class to match the aegisub style format but with yaml, cause ye
 # set up the full effects table from https://aegisub.org/docs/latest/ass_tags/
 
 class Effect:
-    """ A Modular model for a single Aegisub text effect"""
+    """ A Modular model for a single Aegisub text effect
+
+    Effects are immutable and render their tag once, when they are made. The index holds one prototype per
+    effect and `with_arg` makes the configured copies the bucket stores, so nothing is copied per caption.
+    """
+    __slots__ = ('name', 'ass_switch', 'arg_name', 'arg', 'suffix', 'sticky', 'data', '_tag')
+
     def __init__(self, name:str=None, ass_switch:str=None, arg_name:str=None, arg=None, suffix=None, sticky=False, data:dict=None):
-        self.name:str = name # for indexing
+        assign = super().__setattr__
+        assign('name', name) # for indexing
         
         # aegisub properties for rendering tag
-        self.ass_switch:str = ass_switch
-        self.arg_name = arg_name
-        self.arg = arg
-        self.suffix = suffix or ''
-        self.sticky = sticky # this is only for if you want the effect to take place afterwards without a style reset
+        assign('ass_switch', ass_switch)
+        assign('arg_name', arg_name)
+        assign('arg', arg)
+        assign('suffix', suffix or '')
+        assign('sticky', sticky) # this is only for if you want the effect to take place afterwards without a style reset
     
-        self.data:dict = data # holds other data when 
+        assign('data', data) # holds other data when 
+        assign('_tag', self.render())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable, use with_arg for a changed copy")
+
+    def __reduce__(self):
+        return (type(self), (self.name, self.ass_switch, self.arg_name, self.arg, self.suffix, self.sticky, self.data))
+
+    def with_arg(self, arg):
+        """ The same effect with another arg """
+        return type(self)(self.name, self.ass_switch, self.arg_name, arg, self.suffix, self.sticky, self.data)
+
+    def render(self):
+        """ Builds the tag string, see `tag` """
+        return "{\\" + self.ass_switch + str(self.arg or '') + self.suffix + "}"
         
     def tag(self):
         """ Returns the tag as it should be given inline in the ASS file """
-        return "{\\" + self.ass_switch + str(self.arg or '') + self.suffix + "}"
+        return self._tag
     
     def off(self):
         # for use with things like bold in which 0 turns the effect back off
@@ -67,36 +335,56 @@ class Effect:
     
 class Emoji(Effect):
     """ Emoji subclasses Effect but only returns emoji above the text """
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         return self.arg + "\\N" 
 
 class Image(Effect):
     """ Image does nothing to the text but acts as a trigger to grab from the bucket"""
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         return ""
     
 class Video(Effect):
     """ Video does nothing to the text but acts as a trigger to grab from the bucket"""
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         return ""
 
 class Audio(Effect):
     """ Video does nothing to the text but acts as a trigger to grab from the bucket"""
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         return ""
 
 class Color(Effect):
     """ Performs RGB->BRG conversion in the tag """
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         return "{\\" + self.ass_switch + str(rgb_mirror(self.arg) or '') + self.suffix + "}"
 
 class Alpha(Effect):
     """ Performs (0.0, 1.0) ranged alpha to Hex FF inverted (ass format)"""
-    def tag(self):
+    __slots__ = ()
+    def render(self):
         trans = int(255 * (1.0 - float(self.arg)))
         return "{\\" + self.ass_switch + str(hex(trans)).replace('0x', '') + self.suffix + "}"
 
+class OverlayHit(NamedTuple):
+    """ An overlay of the bucket's overlay table (`EffectBucket.overlays`) triggered from `start` to `end` seconds """
+    overlay_id: str
+    start: float
+    end: float
+
 # Effect Bucket
+
+_MISSING = object() # tells a cached "no effect" (None) apart from a cache miss
+
+MATCH_MODES = ('exact', 'hybrid', 'semantic')
+
+def lexical_tokens(text:str) -> list[str]:
+    """ Case-folded words of `text` with punctuation dropped, as used by the exact/lexical indexes """
+    return re.findall(r"[\w']+", text.casefold())
         
 class EffectIndex:
     def __init__(self):
@@ -138,9 +426,18 @@ class EffectIndex:
 
 class EffectBucket:
     """ Holds high level bucket of effects and styles """
-    def __init__(self, load_file=None):
-        self.effects:SemanticDict = SemanticDict()
+    def __init__(self, load_file=None, embedding_cache:EmbeddingCache=None, search_cache_size=4096, dtype='float32'):
+        self.effects:SemanticDict = SemanticDict(cache=embedding_cache, dtype=dtype)
         self.index:EffectIndex = EffectIndex()
+        # remembers search results for repeated caption text, tied to the version of `effects` it was filled from
+        self.search_cache:LRUCache = LRUCache(search_cache_size)
+        self._search_cache_version = self.effects.version
+        # exact/lexical indexes over the keys, rebuilt whenever `effects` changes
+        self.match:str = 'semantic' # one of MATCH_MODES, can be set per bucket in the yaml config section
+        self.exact_index:dict[str, list[str]] = {}
+        self.token_index:dict[str, list[str]] = {}
+        self._phrases:dict[str, str] = {} # key -> its normalized phrase
+        self._lexical_version = None
         self.overlays:dict[str, dict] = {}
         self.styles:dict = {
             'Default': {
@@ -151,80 +448,190 @@ class EffectBucket:
                 'shadow_color': '000000'
             }
         }
+        self._compiled:dict[tuple, Effect] = {} # (effect name, arg type, arg) -> the shared configured effect
         self.index.config()
         if load_file is not None:
             self.load_from_yaml(load_file)
         
     def init_effect(self, effect_name:str, arg=1):
-        """ Finds the effect in the index and then copies it, overwriting the arg value """
-        e = self.index.get(effect_name)
-        ie = None
-        if e:
-            ie = copy.deepcopy(self.index.get(effect_name))
-            ie.arg = arg
+        """ Finds the effect in the index and returns it configured with `arg`, shared by every entry using the same pair """
+        # the type is part of the key: 1, 1.0 and True are equal but render different tags
+        key = (effect_name, type(arg), arg)
+        try:
+            ie = self._compiled.get(key)
+        except TypeError: # unhashable arg, nothing to share
+            key, ie = None, None
+        if ie is None:
+            e = self.index.get(effect_name)
+            if e:
+                ie = e.with_arg(arg)
+                if key is not None:
+                    self._compiled[key] = ie
         return ie
 
     def add_one(self, text:str, effect_name:str|dict, arg=1):
-        e = self.init_effect(effect_name, arg=arg)
-        if e is not None:
-            if text not in self.effects.data:
-                self.effects.add(text, [e])
-            else:
-                self.effects.data[text].append(e)
-        else:
-            raise ValueError(f"Effect {effect_name} not found.")
+        self.add_many([(text, effect_name, arg)])
 
     def add(self, text:str, effect_name:str|dict, arg=1):
         """ Adds the effect to the bucket by name """
-        if isinstance(effect_name, dict): # if a dict, add multiple effects
-            # use effect data for storing the arg pairs
-            for name, argument in effect_name.items():
-                self.add_one(text, name, arg=argument)
-        else:
-            self.add_one(text, effect_name, arg=arg)
+        self.add_many([(text, effect_name, arg)])
+
+    def add_many(self, entries):
+        """ Adds (text, effect_name[, arg]) entries, embedding all of the new texts together in one batch """
+        pending:dict[str, list[Effect]] = {}
+        for text, effect_name, *arg in entries:
+            if isinstance(effect_name, dict): # if a dict, add multiple effects
+                # use effect data for storing the arg pairs
+                pairs = effect_name.items()
+            else:
+                pairs = [(effect_name, arg[0] if arg else 1)]
+            for name, argument in pairs:
+                e = self.init_effect(name, arg=argument)
+                if e is None:
+                    raise ValueError(f"Effect {name} not found.")
+                if text in self.effects: # already embedded, just stack the effect
+                    self.effects[text].append(e)
+                else:
+                    pending.setdefault(text, []).append(e)
+        self.effects.add_many(pending.items())
+        self.search_cache.clear()
+
+    def _search_key(self, query:str, threshold, n):
+        # the tokenizer ignores whitespace, so runs of it can share one cache entry
+        if self.effects.version != self._search_cache_version: # keys were added or removed behind our back
+            self.search_cache.clear()
+            self._search_cache_version = self.effects.version
+        return (" ".join(query.split()), float(threshold), int(n), self.match)
+
+    def _build_lexical_index(self):
+        self.exact_index, self.token_index, self._phrases = {}, {}, {}
+        for key in self.effects.keys:
+            tokens = lexical_tokens(key)
+            if not tokens: # e.g. "%", only reachable semantically
+                continue
+            self._phrases[key] = " ".join(tokens)
+            self.exact_index.setdefault(self._phrases[key], []).append(key)
+            for token in set(tokens):
+                self.token_index.setdefault(token, []).append(key)
+        self._lexical_version = self.effects.version
+
+    def lexical_search(self, query:str, n=1) -> list[tuple[str, list, float]]:
+        """ Bucket keys that appear word for word in `query`, without touching the model
+
+        Keys equal to the whole query come first (exact case before other casings), then keys found as a
+        phrase inside it, longest first. Results use the `SemanticDict.get` tuple shape with distance 0.0.
+        """
+        if self._lexical_version != self.effects.version:
+            self._build_lexical_index()
+        tokens = lexical_tokens(query)
+        if not tokens or n < 1:
+            return []
+        phrase = " ".join(tokens)
+        exact = sorted(self.exact_index.get(phrase, []), key=lambda key: key != query.strip())
+        found = set(exact)
+        contained = []
+        if len(tokens) > 1:
+            padded = f" {phrase} "
+            for token in dict.fromkeys(tokens):
+                for key in self.token_index.get(token, []):
+                    if key not in found and f" {self._phrases[key]} " in padded:
+                        found.add(key)
+                        contained.append(key)
+            contained.sort(key=lambda key: (-self._phrases[key].count(" "), self.effects.entries[key].row))
+        return [(key, self.effects[key], 0.0) for key in (exact + contained)[:n]]
+
+    def cache_info(self) -> dict:
+        """ Hit/miss statistics of the search cache """
+        return self.search_cache.info()
             
     def search(self, query:str, threshold=0.2, n=1) -> Effect:
         """ Semantically find the effect in the bucket by query """
-        r = self.effects.get(query, threshold=threshold, n=n) # threshold based on paraphrase MiniLM-L6-v2
-        if len(r) == 0:
-            return None
-        print(r, query)
-        return [v[1] for v in r] # value of the first effect returned
+        return self.search_many([query], threshold=threshold, n=n, batch_size=1)[0]
+
+    def search_many(self, queries:list[str], threshold=0.2, n=1, batch_size=64) -> list[list]:
+        """ Batched `search`: one entry per query, None where nothing in the bucket is close enough
+
+        Depending on `self.match`, queries are resolved through the exact/lexical indexes ('exact'),
+        through them first and the model only for the rest ('hybrid'), or through the model alone ('semantic').
+        """
+        keys = [self._search_key(query, threshold, n) for query in queries]
+        results = {}
+        for key in keys:
+            if key not in results:
+                results[key] = self.search_cache.get(key, _MISSING)
+            else: # repeated within this batch, served by the same lookup
+                self.search_cache.hits += 1
+
+        found:dict[tuple, list] = {}
+        missing = [key for key, r in results.items() if r is _MISSING]
+        if self.match != 'semantic':
+            for key in missing:
+                r = self.lexical_search(key[0], n=n)
+                if r or self.match == 'exact':
+                    found[key] = r
+        # only texts nothing else resolved go to the model, each of them once
+        semantic = [key for key in missing if key not in found]
+        found.update(zip(semantic, self.effects.get_many([key[0] for key in semantic], threshold=threshold, n=n, batch_size=batch_size)))
+
+        for key in missing:
+            r = found[key]
+            result = None
+            if len(r) > 0:
+                log.debug("matched %r: %s", key[0], r)
+                result = [v[1] for v in r] # value of the effects returned
+            results[key] = result
+            self.search_cache.put(key, result)
+        return [results[key] for key in keys]
 
     def load_from_yaml(self, filepath):
         with open(filepath, 'r') as f:
             config = yaml.safe_load(f)
-        for entry in config.get('effects', []):
-            self.add(*entry)
+        self.add_many(config.get('effects', []))
         self.styles = config.get('styles', {})
         self.overlays = config.get('overlays', {})
+        settings = config.get('config') or {}
+        self.set_match(settings.get('match', self.match))
+        if 'index' in settings or 'nprobe' in settings:
+            self.set_index(settings.get('index', 'exact'), nprobe=settings.get('nprobe'))
+        self.effects.build_index() # big buckets cluster their keys here, once, instead of on the first search
+
+    def set_match(self, match:str):
+        """ Choose how captions are matched to keys: 'exact', 'hybrid' (exact, then semantic) or 'semantic' """
+        if match not in MATCH_MODES:
+            raise ValueError(f"Match mode {match} not found, use one of {', '.join(MATCH_MODES)}.")
+        self.match = match
+
+    def set_index(self, index:str, nprobe=None):
+        """ Choose how keys are searched: 'exact' scans them all, 'ivf' only the `nprobe` closest clusters (see lib/ann.py) """
+        if index not in INDEXES:
+            raise ValueError(f"Index {index} not found, use one of {', '.join(INDEXES)}.")
+        self.effects.set_index(index, nprobe=nprobe)
+        self.search_cache.clear() # approximate results differ from exact ones
+
+class AssWriter:
+    """ Writes an ASS script to an open text file as it is produced: the header right away, then one event per `write` """
+    def __init__(self, f, font="Arial Black", font_size=180, primary_color="&H00FFFFFF&", play_res=(1920, 1080)):
+        self.f = f
+        self.events = 0
+        f.write(MemeCat.ass_header(font, font_size, primary_color, play_res))
+
+    def write(self, line:str):
+        # events are separated, not terminated, by newlines, the same as a joined script
+        self.f.write(("\n" if self.events else "") + line)
+        self.events += 1
 
 # Main class
 
 class MemeCat:
             
     @staticmethod
-    def generate_subtitles(word_list, bucket:EffectBucket, font="Arial Black", font_size=180, primary_color="&H00FFFFFF&", words_per_line=1, threshold=0.2, search_n=1):
-        """
-        Generate an ASS subtitle file (as a string) from a list of (start, end, text) tuples.
-        We show by default one word per line. The text is center-middle. Fade effects are optional.
-        Aegisub is already part of ffmpeg so it will read a properly formatted ass script
-
-        Parameters:
-        - word_list: A list of tuples: (start_time, end_time, text)
-        - font: Default Font family for the subtitles.
-        - font_size: Font size in points.
-        - primary_color: ASS color code. Default: white.
-        """    
-        threshold = float(threshold)
-        
-
+    def ass_header(font="Arial Black", font_size=180, primary_color="&H00FFFFFF&", play_res=(1920, 1080)):
         # TODO Add more styles here
-        ass_header = f"""[Script Info]
+        return f"""[Script Info]
 ; Script generated by Python
 ScriptType: v4.00+
-PlayResX: 1920
-PlayResY: 1080
+PlayResX: {play_res[0]}
+PlayResY: {play_res[1]}
 Collisions: Normal
 ScaledBorderAndShadow: yes
 
@@ -237,73 +644,239 @@ Style: Default,{font},{font_size},{primary_color},&H000000FF&,&H00000000&,&H8000
 Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 """
 
-        dialogue_lines = []
-        overlays:list[dict] = []
-        audio_effects:list[dict] = []
-        top_k_words:dict[str, int] = {}
-        full_text = ""
-        
-        for i in range(0, len(word_list), words_per_line):
-            # get chunk and text
-            chunk = word_list[i:i+words_per_line]
-            start_time = chunk[0][0]
-            end_time = chunk[-1][1]
-            text = " ".join(w[2] for w in chunk)
-            full_text += " " + text
-            
-            # get top_k for text frequency
-            wk = text.strip(r'.-!? ').lower()
-            if wk not in top_k_words:
-                top_k_words[wk] = 0
-            top_k_words[wk] += 1
-            
+    @staticmethod
+    def iter_chunks(words, words_per_line=1):
+        """ Group (start, end, text) words, from any iterable, into (start, end, text) caption chunks """
+        chunk = []
+        for w in words:
+            chunk.append(w)
+            if len(chunk) == words_per_line:
+                yield (chunk[0][0], chunk[-1][1], " ".join(w[2] for w in chunk))
+                chunk = []
+        if chunk:
+            yield (chunk[0][0], chunk[-1][1], " ".join(w[2] for w in chunk))
+
+    @staticmethod
+    def iter_events(words, bucket:EffectBucket, words_per_line=1, threshold=0.2, search_n=1, batch_size=64, word_counts:TopK=None):
+        """
+        Lazily turn words into caption events, so captions can be produced while the words are still coming in.
+
+        Chunks are searched `batch_size` at a time, then yielded one by one as (text, dialogue line, overlays,
+        audio effects) where overlays and audio effects are the entries that chunk triggered.
+        Words for the top_k analysis are counted in `word_counts` when given.
+        """
+        threshold = float(threshold)
+        batch = []
+        for chunk in itertools.chain(MemeCat.iter_chunks(words, words_per_line), [None]):
+            if chunk is not None:
+                batch.append(chunk)
+                if len(batch) < batch_size:
+                    continue
+            if not batch:
+                break
             # find any n effects that should be applied given the text
-            effect = bucket.search(text, threshold=threshold, n=search_n)
-
-            start_h, start_m, start_s = seconds_to_hms(start_time)
-            end_h, end_m, end_s = seconds_to_hms(end_time)
-
-            # This is where the effects bucket comes into play
-            effect_str, effect_str_end = "", ""
-                
-            if effect is not None:
-                for eff in effect:
-                    if isinstance(eff, list):
-                        for e in eff:
-                            # If Effect is an Image or video, add to the overlay_effects list
-                            # Idea is to output the timings so that the ffmpeg overlay process can insert correctly given the other settings
-                            print(e)
-                            if isinstance(e, (Image, Video)):
-                                print('IMAGE', e.arg)
-                                # get the image from self.overlays
-                                ol = copy.deepcopy(bucket.overlays.get(e.arg))
-                                # add times to overlay_effects
-                                ol['start_time'] = float(start_time)
-                                duration = ol.get('duration')
-                                if duration is None:
-                                    ol['end_time'] = float(end_time)
-                                else:
-                                    ol['end_time'] = float(start_time) + duration
-                                overlays.append(ol)
-                            elif isinstance(e, Audio):
-                                el = {'volume': e.arg, 'start': float(start_time), 'end': float(end_time)}
-                                audio_effects.append(el)
-                            effect_str += e.tag()
-                    else:
-                        effect_str = eff.tag()
-
-            line = f"Dialogue: 0,{start_h}:{start_m}:{start_s:.2f},{end_h}:{end_m}:{end_s:.2f},Default,,0,0,0,,{effect_str}{text}{effect_str_end}"
-            dialogue_lines.append(line)
-            
-        top_k = dict(sorted(top_k_words.items(), key=lambda item: item[1], reverse=True))
-        print(top_k)
+            effects = bucket.search_many([c[2] for c in batch], threshold=threshold, n=search_n, batch_size=batch_size)
+            for (start_time, end_time, text), effect in zip(batch, effects):
+                if word_counts is not None:
+                    # get top_k for text frequency
+                    word_counts.add(text.strip(r'.-!? ').lower())
+                yield (text, *MemeCat.chunk_event(start_time, end_time, text, effect, bucket))
+            batch = []
+
+    @staticmethod
+    def chunk_event(start_time, end_time, text, effect, bucket:EffectBucket):
+        """ The dialogue line, overlays and audio effects for one caption chunk and its search result """
+        overlays:list[OverlayHit] = []
+        audio_effects:list[dict] = []
+        start_h, start_m, start_s = seconds_to_hms(start_time)
+        end_h, end_m, end_s = seconds_to_hms(end_time)
+
+        # This is where the effects bucket comes into play
+        effect_str, effect_str_end = "", ""
             
-        return ass_header + "\n".join(dialogue_lines), overlays, audio_effects, top_k, full_text
+        if effect is not None:
+            for eff in effect:
+                if isinstance(eff, list):
+                    for e in eff:
+                        # If Effect is an Image or video, add to the overlay_effects list
+                        # Idea is to output the timings so that the ffmpeg overlay process can insert correctly given the other settings
+                        log.debug("effect %s %r", e.name, e.arg)
+                        if isinstance(e, (Image, Video)):
+                            # the image stays in bucket.overlays, the hit only records which one and when
+                            config = bucket.overlays.get(e.arg)
+                            if config is None:
+                                raise ValueError(f"Overlay {e.arg} not found.")
+                            duration = config.get('duration')
+                            overlays.append(OverlayHit(e.arg, float(start_time), float(end_time) if duration is None else float(start_time) + duration))
+                        elif isinstance(e, Audio):
+                            el = {'volume': e.arg, 'start': float(start_time), 'end': float(end_time)}
+                            audio_effects.append(el)
+                        effect_str += e.tag()
+                else:
+                    effect_str = eff.tag()
+
+        line = f"Dialogue: 0,{start_h}:{start_m}:{start_s:.2f},{end_h}:{end_m}:{end_s:.2f},Default,,0,0,0,,{effect_str}{text}{effect_str_end}"
+        return line, overlays, audio_effects
+
+    @staticmethod
+    def generate_subtitles(word_list, bucket:EffectBucket, font="Arial Black", font_size=180, primary_color="&H00FFFFFF&", words_per_line=1, threshold=0.2, search_n=1, batch_size=64):
+        """
+        Generate an ASS subtitle file (as a string) from a list of (start, end, text) tuples.
+        We show by default one word per line. The text is center-middle. Fade effects are optional.
+        Aegisub is already part of ffmpeg so it will read a properly formatted ass script
+
+        Parameters:
+        - word_list: A list of tuples: (start_time, end_time, text)
+        - font: Default Font family for the subtitles.
+        - font_size: Font size in points.
+        - primary_color: ASS color code. Default: white.
+        - batch_size: How many caption chunks are embedded together when searching the bucket.
+        """    
+        ass = io.StringIO()
+        word_counts = TopK()
+        texts = []
+        overlays, audio_effects = MemeCat.write_subtitles(
+            word_list, bucket, ass, font=font, font_size=font_size, primary_color=primary_color, words_per_line=words_per_line,
+            threshold=threshold, search_n=search_n, batch_size=batch_size, word_counts=word_counts, texts=texts,
+        )
+        top_k = dict(word_counts.most_common())
+        full_text = "".join(" " + text for text in texts)
+        return ass.getvalue(), overlays, audio_effects, top_k, full_text
+
+    @staticmethod
+    def write_subtitles(words, bucket:EffectBucket, f, font="Arial Black", font_size=180, primary_color="&H00FFFFFF&", words_per_line=1, threshold=0.2, search_n=1, batch_size=64, word_counts:TopK=None, texts:list=None, play_res=(1920, 1080)):
+        """
+        Like `generate_subtitles`, but every event goes straight to the open text file `f` as soon as its chunk is
+        searched, so nothing grows with the length of the video except the effect hits. `words` can be any iterable.
+
+        Parameters:
+        - word_counts (TopK): Counts the caption words for the top_k analysis (bounded, see lib/topk.py).
+        - texts (list): Collects the caption texts when given.
+        - play_res (tuple[int, int]): The script's coordinate space, which libass stretches over the video frame.
+        - The rest as in `generate_subtitles`.
+
+        Returns:
+        - tuple[list[OverlayHit], list[dict]]: (overlays, audio_effects) triggered by the captions.
+        """
+        writer = AssWriter(f, font, font_size, primary_color, play_res)
+        overlays:list[OverlayHit] = []
+        audio_effects:list[dict] = []
+        events = MemeCat.iter_events(words, bucket, words_per_line=words_per_line, threshold=threshold, search_n=search_n, batch_size=batch_size, word_counts=word_counts)
+        for text, line, chunk_overlays, chunk_audio in events:
+            writer.write(line)
+            overlays.extend(chunk_overlays)
+            audio_effects.extend(chunk_audio)
+            if texts is not None:
+                texts.append(text)
+        return overlays, audio_effects
     
     @staticmethod
-    def burn(
+    def decode_audio(input_video:str):
+        """ Decode the input's audio once to 16 kHz mono float32 PCM, shared by whisper and any audio analysis """
+        t = time.time()
+        with profiler.stage('decode_audio'):
+            audio = load_audio(input_video)
+        log.info("Decoded %.1fs of audio in %.2fs", len(audio) / SAMPLE_RATE, time.time() - t)
+        return audio
+
+    @staticmethod
+    def transcribe(input_video:str, model='small', cache_dir=None, use_cache=True, workers=1, chunk_seconds=60.0, audio=None, **options) -> dict:
+        """
+        Transcribe the video with whisper, or load the transcript of an earlier run on the same audio.
+
+        Parameters:
+        - input_video (str): Path to the input video.
+        - model (str): Whisper model name, part of the cache key.
+        - cache_dir (str): Root cache directory (see lib.cache.default_cache_dir).
+        - use_cache (bool): Whether to read and write the transcript cache.
+        - workers (int): With more than 1, the audio is cut at silences into about `chunk_seconds` long chunks
+            which are transcribed on that many processes (see lib/asr.py).
+        - chunk_seconds (float): Target chunk length for parallel transcription.
+        - audio (np.ndarray): Already decoded audio (see `decode_audio`). Otherwise it is decoded here, only on a cache miss.
+        - options: Extra keyword arguments for whisper's `transcribe`, also part of the cache key.
+
+        Returns:
+        - dict: The transcript (see lib/transcript.py), with 'segments' and 'words'.
+        """
+        options = {'word_timestamps': True, **options}
+        cache, key = None, None
+        if use_cache:
+            cache = TranscriptCache(cache_dir)
+            # chunked results differ slightly from whole file ones, but not between worker counts
+            key_options = options if workers <= 1 else {**options, 'chunk_seconds': float(chunk_seconds)}
+            key = cache.key(audio_fingerprint(input_video), model, key_options)
+            transcript = cache.get(key)
+            if transcript is not None: # no model load at all on a hit
+                log.info("Transcript loaded from cache %s", key)
+                return transcript
+
+        if audio is None:
+            audio = MemeCat.decode_audio(input_video)
+        if workers > 1:
+            with profiler.stage('transcribe'):
+                result = transcribe_parallel(audio, model, workers=workers, chunk_seconds=chunk_seconds, **options)
+        else:
+            whisper_model = models.whisper(model)
+            with profiler.stage('transcribe'):
+                result = whisper_model.transcribe(audio, **options)
+        transcript = transcript_from_whisper(result, model)
+        if cache is not None:
+            cache.put(key, transcript)
+        return transcript
+
+    @staticmethod
+    def stream_words(input_video:str, model='small', cache_dir=None, use_cache=True, chunk_seconds=60.0, transcript_out=None, **options):
+        """
+        Like `transcribe`, but yields (start, end, text) words while whisper is still working.
+
+        Whisper runs chunk by chunk (cut at silences, see lib/asr.py) on a background thread, at most a few
+        segments ahead of the consumer. The finished transcript is cached and saved to `transcript_out` once
+        every chunk is done. It shares its cache entries with parallel transcription, which cuts the same chunks.
+        """
+        options = {'word_timestamps': True, **options}
+        cache, key = None, None
+        if use_cache:
+            cache = TranscriptCache(cache_dir)
+            key = cache.key(audio_fingerprint(input_video), model, {**options, 'chunk_seconds': float(chunk_seconds)})
+            transcript = cache.get(key)
+            if transcript is not None:
+                log.info("Transcript loaded from cache %s", key)
+                if transcript_out is not None:
+                    save_transcript(transcript, transcript_out)
+                yield from transcript_words(transcript)
+                return
+
+        audio = MemeCat.decode_audio(input_video)
+        segments = []
+        for seg in threaded(transcribe_stream(audio, model, chunk_seconds=chunk_seconds, **options)):
+            seg['id'] = len(segments)
+            segments.append(seg)
+            for w in seg.get('words', []):
+                if w['word'].strip():
+                    yield (w['start'], w['end'], w['word'].strip())
+
+        transcript = transcript_from_whisper({'segments': segments}, model)
+        if cache is not None:
+            cache.put(key, transcript)
+        if transcript_out is not None:
+            save_transcript(transcript, transcript_out)
+
+    @staticmethod
+    def load_bucket(bucket_path=None, cache_dir=None, embedding_cache=True, search_cache_size=4096, match=None, index=None, nprobe=None, embedding_dtype='float32') -> EffectBucket:
+        """ Load up a bucket, reusing key embeddings from earlier runs """
+        with profiler.stage('bucket_load'):
+            bucket = EffectBucket(bucket_path, embedding_cache=EmbeddingCache(cache_dir) if embedding_cache else None, search_cache_size=search_cache_size, dtype=embedding_dtype)
+        if match is not None:
+            bucket.set_match(match)
+        if index is not None or nprobe is not None:
+            with profiler.stage('index_build'):
+                bucket.set_index(index or bucket.effects.index.name, nprobe=nprobe)
+                bucket.effects.build_index()
+        return bucket
+
+    @staticmethod
+    def prepare(
         input_video:str,
-        output_video:str,
         bucket_path=None,
         model='small',
         words=1,
@@ -313,192 +886,784 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         font_size=None,
         primary_color=None,
         ass_path="subtitles.ass",
+        batch_size=64,
+        cache_dir=None,
+        embedding_cache=True,
+        search_cache_size=4096,
+        match=None,
+        index=None,
+        nprobe=None,
+        embedding_dtype='float32',
+        transcript_cache=True,
+        transcript_in=None,
+        transcript_out=None,
+        transcribe_workers=1,
+        chunk_seconds=60.0,
+        stream=False,
+        remove_silence=None,
+        silence_padding=0.15,
+        play_res=(1920, 1080),
+        bucket:EffectBucket=None,
+        transcript:dict=None,
+        keep:list=None,
     ):
-        # Load up a bucket
-        bucket = EffectBucket(bucket_path)
+        """
+        Everything `burn` does before ffmpeg: transcribe, look up effects and write the ASS file to `ass_path`.
+        Takes the same settings as `burn`, plus an already loaded `bucket` to use instead of `bucket_path`
+        and an already made `transcript` to use instead of running whisper.
 
-        model = whisper.load_model(model)
-        result = model.transcribe(input_video, word_timestamps=True)
+        With `remove_silence`, the words are moved onto a timeline without the pauses longer than that many seconds
+        (see lib/cuts.py) before any caption is made, and the spans of the input to keep are appended to `keep`,
+        which `write` needs to cut the video the same way.
 
-        # Extract words and their timestamps
-        word_list = []
-        for seg in result['segments']:
-            for w in seg.get('words', []):
-                w_text = w['word'].strip()
-                if w_text:
-                    start = w['start']
-                    end = w['end']
-                    word_list.append((start, end, w_text))
-
-        # Fallback if no word-level timestamps
-        if not word_list:
-            for seg in result['segments']:
-                word_list.append((seg['start'], seg['end'], seg['text'].strip()))
-
-        ass_content, overlays, audio_effects, top_k, full_text = MemeCat.generate_subtitles(
-            word_list,
-            bucket,
+        With `stream`, whisper works through the audio chunk by chunk on a background thread while the caption
+        chunks it has finished are searched and their events written straight to the ASS file.
+
+        Returns:
+        - tuple[list[OverlayHit], list[dict], dict]: (overlays, audio_effects, overlay_table) to hand to `write`,
+            where overlay_table is the bucket's overlays the hits refer to.
+        """
+        if bucket is None:
+            bucket = MemeCat.load_bucket(bucket_path, cache_dir=cache_dir, embedding_cache=embedding_cache, search_cache_size=search_cache_size, match=match, index=index, nprobe=nprobe, embedding_dtype=embedding_dtype)
+
+        if stream and transcript_in is None and transcript is None:
+            word_source = MemeCat.stream_words(input_video, model=model, cache_dir=cache_dir, use_cache=transcript_cache, chunk_seconds=float(chunk_seconds), transcript_out=transcript_out)
+            # small batches keep the captions close behind whisper instead of waiting for a full model batch
+            batch_size, stage = min(int(batch_size), 16), 'transcribe_and_subtitles'
+        else:
+            if transcript is None and transcript_in is not None: # reuse (or hand edit) a transcript instead of running whisper
+                transcript = load_transcript(transcript_in)
+            elif transcript is None:
+                transcript = MemeCat.transcribe(input_video, model=model, cache_dir=cache_dir, use_cache=transcript_cache, workers=int(transcribe_workers), chunk_seconds=float(chunk_seconds))
+            if transcript_out is not None:
+                save_transcript(transcript, transcript_out)
+            word_source = transcript_words(transcript)
+            profiler.count('words', len(word_source))
+            stage = 'subtitles'
+        if remove_silence:
+            keep = [] if keep is None else keep
+            word_source = compact_words(word_source, keep, min_gap=float(remove_silence), padding=float(silence_padding), duration=probe_duration(input_video))
+
+        word_counts = TopK()
+        with profiler.stage(stage), open(ass_path, 'w', encoding='utf-8') as f:
+            overlays, audio_effects = MemeCat.write_subtitles(
+                word_source,
+                bucket,
+                f,
+                font=font,
+                font_size=font_size,
+                primary_color=primary_color,
+                words_per_line=int(words),
+                threshold=float(threshold),
+                search_n=int(n),
+                batch_size=int(batch_size),
+                word_counts=word_counts,
+                play_res=play_res,
+            )
+        log.info("Top words: %s", word_counts.most_common(20))
+        log.info("Search cache: %s", bucket.cache_info())
+        if remove_silence:
+            log.info("Keeping %.1fs of the input in %d spans", kept_seconds(keep), len(keep))
+            profiler.set('silence_removal', {'spans': len(keep), 'kept_seconds': kept_seconds(keep)})
+        MemeCat._profile_bucket(bucket)
+        return overlays, audio_effects, bucket.overlays
+
+    @staticmethod
+    def _profile_bucket(bucket:EffectBucket):
+        """ Add the bucket's embedding and search figures to the run report """
+        profiler.set('semantic_dict', dict(bucket.effects.stats, keys=len(bucket.effects.keys)))
+        profiler.set('search_cache', bucket.cache_info())
+
+    @staticmethod
+    def burn(
+        input_video:str,
+        output_video:str,
+        bucket_path=None,
+        model='small',
+        words=1,
+        threshold=0.2,
+        n=1,
+        font=None,
+        font_size=None,
+        primary_color=None,
+        ass_path="subtitles.ass",
+        batch_size=64,
+        cache_dir=None,
+        embedding_cache=True,
+        search_cache_size=4096,
+        match=None,
+        index=None,
+        nprobe=None,
+        embedding_dtype='float32',
+        transcript_cache=True,
+        transcript_in=None,
+        transcript_out=None,
+        transcribe_workers=1,
+        chunk_seconds=60.0,
+        stream=False,
+        remove_silence=None,
+        silence_padding=0.15,
+        segments=1,
+        render_workers=None,
+        preview=False,
+        preview_start=None,
+        preview_end=None,
+        preview_hits=6,
+        preview_context=1.5,
+        preview_height=360,
+        variants:list[dict]=None,
+    ):
+        settings = dict(
+            bucket_path=bucket_path,
+            model=model,
+            words=words,
+            threshold=threshold,
+            n=n,
             font=font,
             font_size=font_size,
             primary_color=primary_color,
-            words_per_line=int(words),
-            threshold=float(threshold),
-            search_n=int(n),
+            batch_size=batch_size,
+            cache_dir=cache_dir,
+            embedding_cache=embedding_cache,
+            search_cache_size=search_cache_size,
+            match=match,
+            index=index,
+            nprobe=nprobe,
+            embedding_dtype=embedding_dtype,
+            transcript_cache=transcript_cache,
+            transcribe_workers=transcribe_workers,
+            chunk_seconds=chunk_seconds,
+            stream=stream,
+            remove_silence=remove_silence,
+            silence_padding=silence_padding,
         )
+        if variants:
+            return MemeCat.burn_variants(input_video, variants, ass_path=ass_path, transcript_in=transcript_in, transcript_out=transcript_out, **settings)
+
+        keep = []
+        overlays, audio_effects, overlay_table = MemeCat.prepare(input_video, ass_path=ass_path, transcript_in=transcript_in, transcript_out=transcript_out, keep=keep, **settings)
+
+        if preview:
+            return MemeCat.write_preview(
+                input_video, output_video, ass_path, overlays=overlays, audio_effects=audio_effects, overlay_table=overlay_table, keep=keep,
+                start=preview_start, end=preview_end, hits=preview_hits, context=preview_context, height=preview_height,
+            )
+        MemeCat.write(input_video, output_video, ass_path, overlays=overlays, audio_effects=audio_effects, segments=int(segments), render_workers=render_workers, overlay_table=overlay_table, keep=keep)
+
+    @staticmethod
+    def burn_variants(input_video:str, variants:list[dict], ass_path="subtitles.ass", transcript_in=None, transcript_out=None, **settings):
+        """
+        Make several versions of one video: one transcription, then captions per version, then one ffmpeg run
+        that decodes the input once and splits it into every output.
 
-        with open(ass_path, 'w', encoding='utf-8') as f:
-            f.write(ass_content)
+        Each variant is a dict with:
+            - 'output' (str): Path of this version.
+            - 'size' (str): 'WIDTHxHEIGHT' to fill and center crop to, e.g. '1080x1920' for 9:16 (optional).
+            - 'crop' (str): Arguments for ffmpeg's crop filter, applied before `size` (optional).
+            - 'captions' (bool): False for a version without captions, overlays or audio effects (default True).
+              It is still cut like the others with `remove_silence`.
+            - Any `prepare` setting to change for this version: bucket_path, font, font_size, words, threshold, ...
+              The transcription settings (model, stream, transcribe_workers, ...) are shared by every version.
+        The ASS files go next to `ass_path`, numbered by variant. The rest of the parameters as in `burn`.
+        """
+        MemeCat.check_variants(variants)
+        if transcript_in is not None:
+            transcript = load_transcript(transcript_in)
+        else:
+            transcript = MemeCat.transcribe(
+                input_video, model=settings.get('model', 'small'), cache_dir=settings.get('cache_dir'), use_cache=settings.get('transcript_cache', True),
+                workers=int(settings.get('transcribe_workers', 1)), chunk_seconds=float(settings.get('chunk_seconds', 60.0)),
+            )
+        if transcript_out is not None:
+            save_transcript(transcript, transcript_out)
+
+        # the cut list only depends on the transcript and the silence settings, so it is worked out once per
+        # setting and every version cut alike lines up, captioned or not
+        cuts, duration = {}, None
+        def cut_options(options:dict) -> tuple:
+            return (float(options['remove_silence']), float(options.get('silence_padding', 0.15))) if options.get('remove_silence') else None
+
+        name, ext = os.path.splitext(ass_path)
+        outputs, buckets, input_size = [], {}, None
+        for i, variant in enumerate(variants):
+            variant = dict(variant)
+            size, crop = variant.pop('size', None), variant.pop('crop', None)
+            output = {'output': variant.pop('output'), 'video_filter': variant_filter(size, crop)}
+            if not variant.pop('captions', True):
+                options = cut_options({**settings, **variant})
+                if options is not None and options not in cuts:
+                    duration = probe_duration(input_video) if duration is None else duration
+                    keep = cuts[options] = []
+                    for _ in compact_words(transcript_words(transcript), keep, min_gap=options[0], padding=options[1], duration=duration):
+                        pass
+                output['keep'] = cuts.get(options)
+            else:
+                if crop and not size and input_size is None:
+                    input_size = probe_size(input_video)
+                variant_settings = {**settings, 'ass_path': f"{name}.{i}{ext}", 'play_res': variant_play_res(size, crop, input_size), **variant}
+                # versions with the same bucket settings share the loaded bucket
+                bucket_options = {k: variant_settings.get(k) for k in ('bucket_path', 'cache_dir', 'embedding_cache', 'search_cache_size', 'match', 'index', 'nprobe', 'embedding_dtype') if k in variant_settings}
+                key = tuple(sorted(bucket_options.items()))
+                if key not in buckets:
+                    buckets[key] = MemeCat.load_bucket(**bucket_options)
+                keep = []
+                overlays, audio_effects, overlay_table = MemeCat.prepare(input_video, bucket=buckets[key], transcript=transcript, keep=keep, **variant_settings)
+                options = cut_options(variant_settings)
+                if options is not None:
+                    keep = cuts.setdefault(options, keep)
+                output.update(ass_path=variant_settings['ass_path'], overlays=overlays, audio_effects=audio_effects, overlay_table=overlay_table, keep=keep)
+            outputs.append(output)
 
-        MemeCat.write(input_video, output_video, ass_path, overlays=overlays, audio_effects=audio_effects)
+        command = MemeCat.build_variants_command(input_video, outputs)
+        log.info(" ".join(command))
+        run_ffmpeg(command)
 
-        print(f"Done! Created {output_video} with burned-in subtitles.")
+
+    @staticmethod
+    def check_variants(variants:list[dict]):
+        """ Raise a ValueError for a variant without an output or with a key `burn_variants` cannot apply to one version """
+        allowed = set(VARIANT_KEYS) | set(inspect.signature(MemeCat.prepare).parameters) - set(SHARED_SETTINGS)
+        for i, variant in enumerate(variants):
+            if not isinstance(variant, dict) or not variant.get('output'):
+                raise ValueError(f"Variant {i + 1} needs an output.")
+            unknown = sorted(set(variant) - allowed)
+            if unknown:
+                shared = [k for k in unknown if k in SHARED_SETTINGS]
+                raise ValueError(
+                    f"Variant {i + 1} ({variant['output']}) cannot set {', '.join(unknown)}. "
+                    + ("The transcription settings are shared by every version, set them for the whole run. " if shared else "")
+                    + f"A variant takes {', '.join(VARIANT_KEYS)} and the settings of MemeCat.prepare."
+                )
     
     @staticmethod
-    def write(video_path: str, output_path: str, ass_path: str, overlays: list[dict] = None, audio_copy=True, audio_effects=None):
+    def overlay_position(alignment, margin_x, margin_y):
+        alignments = {
+            "top-left": (margin_x, margin_y),
+            "top-center": (f"(main_w-overlay_w)/2+{margin_x}", margin_y),
+            "top": (f"(main_w-overlay_w)/2+{margin_x}", margin_y),
+            "top-right": (f"main_w-overlay_w-{margin_x}", margin_y),
+            "middle-left": (margin_x, f"(main_h-overlay_h)/2+{margin_y}"),
+            "middle-center": (f"(main_w-overlay_w)/2+{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
+            "middle": (f"(main_w-overlay_w)/2+{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
+            "middle-right": (f"main_w-overlay_w-{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
+            "bottom-left": (margin_x, f"main_h-overlay_h-{margin_y}"),
+            "bottom-center": (f"(main_w-overlay_w)/2+{margin_x}", f"main_h-overlay_h-{margin_y}"),
+            "bottom": (f"(main_w-overlay_w)/2+{margin_x}", f"main_h-overlay_h-{margin_y}"),
+            "bottom-right": (f"main_w-overlay_w-{margin_x}", f"main_h-overlay_h-{margin_y}")
+        }
+        return alignments.get(alignment, alignments["top-center"])
+
+    @staticmethod
+    def resolve_overlay(overlay, overlay_table:dict=None) -> tuple[dict, float, float]:
+        """ (configuration, start, end) of an overlay given either as an `OverlayHit` into `overlay_table` or as a full dict """
+        if isinstance(overlay, OverlayHit):
+            return overlay_table[overlay.overlay_id], overlay.start, overlay.end
+        return overlay, overlay['start_time'], overlay['end_time']
+
+    @staticmethod
+    def overlay_graph(overlays:list, source='0:v', first_input=1, prefix='', overlay_table:dict=None, scale=1.0) -> tuple[list[str], list[str], str]:
         """
-        Write the captions and overlays onto a video with specific configurations.
+        Build the overlay part of the filter graph.
+
+        Every distinct `src` becomes one input, every distinct size of it is scaled once, and every distinct
+        placement (src, size, position) becomes one overlay node whose `enable` covers all of its time windows,
+        with overlapping or touching windows merged. Inputs and scaled images are fanned out with `split`.
 
         Parameters:
-        - video_path (str): Path to the input video.
-        - overlays (list[dict]): List of overlay configurations.
-            Each configuration is a dictionary with keys:
-                - 'src': Path to the image.
-                - 'x': X position of the image.
-                - 'y': Y position of the image.
-                - 'width': Width of the image (optional).
-                - 'height': Height of the image (optional).
-                - 'start_time': Start time (in seconds).
-                - 'end_time': End time (in seconds).
-        - output_path (str): Path to save the output video.
-        - ass_path (str): Path to the ASS subtitle file to burn in (required).
-        - audio_copy (bool): Whether to copy audio without re-encoding.
+        - overlays (list[OverlayHit | dict]): Overlays as described in `write`.
+        - source (str): Label of the video stream to draw on.
+        - first_input (int): ffmpeg input index of the first overlay source.
+        - prefix (str): Prefix for the labels this graph creates, so several graphs can share one filter_complex.
+        - overlay_table (dict): The overlay configurations `OverlayHit`s refer to.
+        - scale (float): Sizes, margins and pixel positions are multiplied by this, for a video scaled by as much.
 
         Returns:
-        - None
+        - tuple[list[str], list[str], str]: (input sources in order, filter chains, label of the output stream)
+        """
+        # src -> size -> placement -> time windows, all in order of first appearance
+        placements:dict[str, dict[tuple, dict[tuple, list]]] = {}
+        for overlay in overlays or []:
+            config, start, end = MemeCat.resolve_overlay(overlay, overlay_table)
+            # Handle optional width and height
+            width = config.get('width', 'iw')  # Default to input width
+            height = config.get('height', 'ih')  # Default to input height
+            alignment = config.get('alignment', 'top-center')
+            margin_x = config.get('margin_x', 28)
+            margin_y = config.get('margin_y', 28)
+            if scale != 1.0:
+                width, height, margin_x, margin_y = (scale_length(v, scale) for v in (width, height, margin_x, margin_y))
+
+            if config.get('x') is None or config.get('y') is None:
+                x, y = MemeCat.overlay_position(alignment, margin_x, margin_y)
+            else:
+                x = scale_length(config.get('x'), scale)
+                y = scale_length(config.get('y'), scale)
+
+            sizes = placements.setdefault(config['src'], {})
+            sizes.setdefault((width, height), {}).setdefault((x, y), []).append((start, end))
+
+        inputs, filters = [], []
+        label = source
+        def fan_out(stream, count, name):
+            # a stream feeds several consumers through split, or a single one directly
+            if count == 1:
+                return [stream]
+            outputs = [f"{name}_{i}" for i in range(count)]
+            filters.append(f"[{stream}]split={count}" + "".join(f"[{o}]" for o in outputs))
+            return outputs
+
+        for i, (src, sizes) in enumerate(placements.items()):
+            inputs.append(src)
+            streams = fan_out(f"{first_input + i}:v", len(sizes), f"{prefix}src{i}")
+            for j, (stream, ((width, height), positions)) in enumerate(zip(streams, sizes.items())):
+                # Format, scale, and prepare overlay filter
+                scaled = f"{prefix}img{i}_{j}"
+                filters.append(f"[{stream}]format=rgba,scale=w={width}:h={height}[{scaled}]")
+                for k, (image, ((x, y), windows)) in enumerate(zip(fan_out(scaled, len(positions), scaled), positions.items())):
+                    enable = "+".join(f"between(t,{start},{end})" for start, end in merge_windows(windows))
+                    next_label = f"{prefix}v{i}_{j}_{k}"
+                    filters.append(f"[{label}][{image}]overlay=x={x}:y={y}:enable='{enable}'[{next_label}]")
+                    label = next_label
+        return inputs, filters, label
+
+    @staticmethod
+    def build_command(video_path: str, output_path: str, ass_path: str, overlays: list = None, audio_effects=None, start=None, duration=None, overlay_table:dict=None, keep:list=None, windows:list=None, proxy_scale=None, output_options:list=None) -> list[str]:
+        """
+        The ffmpeg command `write` runs, see `write` for the parameters.
+
+        With `start` (and `duration`) only that piece of the input is rendered. Its frames are moved back onto the
+        original timeline while the filters run, so captions, overlays and volume land on exactly the same frames
+        as in a full render, and the output piece starts at 0.
+
+        With `keep`, everything outside those spans is dropped first and the rest runs on the cut timeline.
+        With `windows`, only those (start, end) spans of that timeline are filtered, and they are played back to back.
+        `proxy_scale` shrinks the video (and the overlays with it) by that factor before any filter draws on it,
+        and `output_options` go in front of the output path (encoder settings).
         """
         if not ass_path:
             raise ValueError("A subtitle file (ass_path) must be provided.")
 
-        def get_overlay_position(alignment, margin_x, margin_y):
-            alignments = {
-                "top-left": (margin_x, margin_y),
-                "top-center": (f"(main_w-overlay_w)/2+{margin_x}", margin_y),
-                "top": (f"(main_w-overlay_w)/2+{margin_x}", margin_y),
-                "top-right": (f"main_w-overlay_w-{margin_x}", margin_y),
-                "middle-left": (margin_x, f"(main_h-overlay_h)/2+{margin_y}"),
-                "middle-center": (f"(main_w-overlay_w)/2+{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
-                "middle": (f"(main_w-overlay_w)/2+{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
-                "middle-right": (f"main_w-overlay_w-{margin_x}", f"(main_h-overlay_h)/2+{margin_y}"),
-                "bottom-left": (margin_x, f"main_h-overlay_h-{margin_y}"),
-                "bottom-center": (f"(main_w-overlay_w)/2+{margin_x}", f"main_h-overlay_h-{margin_y}"),
-                "bottom": (f"(main_w-overlay_w)/2+{margin_x}", f"main_h-overlay_h-{margin_y}"),
-                "bottom-right": (f"main_w-overlay_w-{margin_x}", f"main_h-overlay_h-{margin_y}")
-            }
-            return alignments.get(alignment, alignments["top-center"])
-
-        filter_complex = []
-        input_count = 1  # Start after the main video input
-        overlay_streams = []
-        final_label = '0:v'
-        label = ''
-
-        if overlays:
-            for i, config in enumerate(overlays):
-                # Handle optional width and height
-                width = config.get('width', 'iw')  # Default to input width
-                height = config.get('height', 'ih')  # Default to input height
-                alignment = config.get('alignment', 'top-center')
-                margin_x = config.get('margin_x', 28)
-                margin_y = config.get('margin_y', 28)
-                
-                if config.get('x') is None or config.get('y') is None:
-                    x, y = get_overlay_position(alignment, margin_x, margin_y)
-                else:
-                    x = config.get('x')
-                    y = config.get('y')
-                
-                # Timing
-                start_time = config['start_time']
-                end_time = config['end_time']
+        video_chain, audio_chain = [], []
+        if keep:
+            video_cut, audio_cut = cut_filters(keep)
+            video_chain.append(video_cut)
+            audio_chain.append(audio_cut)
+        if windows:
+            # frames outside the windows are dropped before anything draws on them but keep their time until the end
+            video_chain.append(f"select='{select_expression(windows)}'")
+            audio_chain.append(f"aselect='{select_expression(windows)}'")
+        if proxy_scale:
+            video_chain.append(f"scale=trunc(iw*{proxy_scale}/2)*2:trunc(ih*{proxy_scale}/2)*2")
 
-                # Format, scale, and prepare overlay filter
-                filter_complex.append(f"[{input_count}:v]format=rgba,scale=w={width}:h={height}[img{i}]")
-                next_stream = f"[v{i+1}]"
-                label = final_label if i == 0 else f"v{i}"
-                overlay_streams.append(f"[{label}][img{i}]overlay=x={x}:y={y}:enable='between(t,{start_time},{end_time})'{next_stream}")
-                input_count += 1
+        filter_complex, source = [], '0:v'
+        if start or video_chain:
+            filter_complex.append(f"[0:v]{','.join(([f'setpts=PTS+{start}/TB'] if start else []) + video_chain)}[base]")
+            source = 'base'
 
         # Add subtitles filter
+        sources, overlay_filters, label = MemeCat.overlay_graph(overlays, source=source, overlay_table=overlay_table, scale=proxy_scale or 1.0)
+        filter_complex.extend(overlay_filters)
+        # the windows close up once everything is drawn (nothing to close when a single one starts at 0)
+        window_shift = shift_expression(windows) if windows else "0"
         subtitle_filter = f"ass={ass_path}"
-        if overlays:
-            filter_complex.extend(overlay_streams)
-            filter_complex.append(f"{next_stream}{subtitle_filter}")
+        if window_shift != "0":
+            subtitle_filter += f",setpts='PTS-({window_shift})/TB'"
+        elif start:
+            subtitle_filter += ",setpts=PTS-STARTPTS"
+        if filter_complex:
+            filter_complex.append(f"[{label}]{subtitle_filter}")
             combined_filters = ";".join(filter_complex)
         else:
             combined_filters = subtitle_filter
 
         # Build ffmpeg command
-        command = [
-            "ffmpeg", "-y", "-i", video_path
-        ]
+        command = ["ffmpeg", "-y"]
+        if start:
+            command.extend(["-ss", str(start)])
+        if duration is not None:
+            command.extend(["-t", str(duration)])
+        command.extend(["-i", video_path])
 
-        # Add image inputs
-        if overlays:
-            for config in overlays:
-                command.extend(["-i", config['src']])
+        # Add image inputs, one per distinct source
+        for src in sources:
+            command.extend(["-i", src])
 
         # Add filter complex
         command.extend(["-filter_complex", f'{combined_filters}'])
 
         # Handle audio filtering
-        if len(audio_effects) == 0: # just copy audio
-            command.extend(["-c:a", "copy"])
-        else: # apply audio effects
-            combined_audio_filters = []
+        volume = volume_filter(audio_effects or [], f"{os.path.splitext(ass_path)[0]}.volume.txt")
+        if volume is not None: # apply audio effects
             # TODO Audio can have effects beyond volume
             #   using an audio library like torchaudio
             #   NOTE would need to first extract audio, then formatting
-            for af in audio_effects:
-                combined_audio_filters.append(f"volume=enable='between(t,{af['start']},{af['end']})':volume={af['volume']}")
-            command.extend(["-af", ",".join(combined_audio_filters)])
+            # every volume hit is folded into a single filter
+            audio_chain.append(volume)
+        if window_shift != "0":
+            audio_chain.append(f"asetpts='PTS-({window_shift})/TB',aresample=async=1")
+        if audio_chain and start:
+            audio_chain = [f"asetpts=PTS+{start}/TB", *audio_chain, "asetpts=PTS-STARTPTS"]
+        if audio_chain:
+            command.extend(["-af", ",".join(audio_chain)])
+        else: # just copy audio
+            command.extend(["-c:a", "copy"])
 
         # Add output file
+        command.extend(output_options or [])
         command.append(output_path)
+        return command
+
+    @staticmethod
+    def build_variants_command(video_path:str, outputs:list[dict], output_options:list=None) -> list[str]:
+        """
+        One ffmpeg command writing every output from a single decode of `video_path`: the video (and the audio,
+        where it needs filtering) is fanned out with split/asplit and every branch gets its own filters and maps.
+
+        Parameters:
+        - outputs (list[dict]): Per output: 'output' path and, all optional, 'video_filter' (scale/crop filters),
+            'ass_path', 'overlays', 'audio_effects', 'overlay_table' and 'keep' as in `write`.
+        - output_options (list[str]): Encoder options for every output.
+        """
+        filters, sources = [], []
+        video_labels = [f"vs{i}" for i in range(len(outputs))]
+        filters.append("[0:v]split=" + str(len(outputs)) + "".join(f"[{label}]" for label in video_labels))
+        audio_chains = []
+        for i, output in enumerate(outputs):
+            chain, audio_chain = [], []
+            if output.get('keep'):
+                video_cut, audio_cut = cut_filters(output['keep'])
+                chain.append(video_cut)
+                audio_chain.append(audio_cut)
+            if output.get('video_filter'):
+                chain.append(output['video_filter'])
+            label = video_labels[i]
+            if chain:
+                filters.append(f"[{label}]{','.join(chain)}[vb{i}]")
+                label = f"vb{i}"
+            output_sources, overlay_filters, label = MemeCat.overlay_graph(output.get('overlays'), source=label, first_input=1 + len(sources), prefix=f"o{i}_", overlay_table=output.get('overlay_table'))
+            sources.extend(output_sources)
+            filters.extend(overlay_filters)
+            if output.get('ass_path'):
+                filters.append(f"[{label}]ass={output['ass_path']}[vout{i}]")
+                label = f"vout{i}"
+            video_labels[i] = label
+            if output.get('audio_effects'):
+                volume = volume_filter(output['audio_effects'], f"{os.path.splitext(output['ass_path'])[0]}.volume.txt", name=f"hits{i}")
+                if volume is not None:
+                    audio_chain.append(volume)
+            audio_chains.append(audio_chain)
+
+        # only the outputs with audio filters take a branch of the audio, the rest copy it
+        filtered = [i for i, chain in enumerate(audio_chains) if chain]
+        audio_labels = {i: "0:a" for i in filtered} if len(filtered) == 1 else {i: f"as{i}" for i in filtered}
+        if len(filtered) > 1:
+            filters.append(f"[0:a]asplit={len(filtered)}" + "".join(f"[as{i}]" for i in filtered))
+        for i in filtered:
+            filters.append(f"[{audio_labels[i]}]{','.join(audio_chains[i])}[aout{i}]")
+
+        command = ["ffmpeg", "-y", "-i", video_path]
+        for src in sources:
+            command.extend(["-i", src])
+        command.extend(["-filter_complex", ";".join(filters)])
+        for i, output in enumerate(outputs):
+            command.extend(["-map", f"[{video_labels[i]}]"])
+            if audio_chains[i]:
+                command.extend(["-map", f"[aout{i}]"])
+            else:
+                command.extend(["-map", "0:a?", "-c:a", "copy"])
+            command.extend(output_options or [])
+            command.append(output['output'])
+        return command
+
+    @staticmethod
+    def write_segmented(video_path: str, output_path: str, ass_path: str, overlays: list = None, audio_effects=None, segments=4, workers=None, overlay_table:dict=None):
+        """
+        Render the video as `segments` keyframe aligned pieces in parallel ffmpeg processes and join them losslessly.
+
+        Each piece gets its own ASS file holding only the events that touch it, and only the overlay and audio
+        windows that touch it. The pieces are joined with the concat demuxer without re-encoding.
+
+        Parameters:
+        - segments (int): How many pieces to cut the timeline into (fewer if the input has too few keyframes).
+        - workers (int): How many pieces render at once. Defaults to `segments`.
+        - The rest as in `write`.
+        """
+        duration = probe_duration(video_path)
+        offset = probe_start_time(video_path)
+        keyframes = [k - offset for k in probe_keyframes(video_path)]
+        cuts = sorted({min(keyframes, key=lambda k: abs(k - duration * i / segments)) for i in range(1, segments)} - {0.0}) if keyframes else []
+        bounds = [0.0] + [c for c in cuts if 0.0 < c < duration] + [None]
+
+        with open(ass_path, 'r', encoding='utf-8') as f:
+            ass_content = f.read()
+        with tempfile.TemporaryDirectory(prefix='memecat-segments-') as folder: # removed even when a piece fails
+            ext = os.path.splitext(output_path)[1]
+            commands, pieces = [], []
+            windows = [(o, MemeCat.resolve_overlay(o, overlay_table)) for o in overlays or []]
+            for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+                stop = duration if end is None else end
+                piece_ass = os.path.join(folder, f"piece{i}.ass")
+                with open(piece_ass, 'w', encoding='utf-8') as f:
+                    f.write(prune_ass(ass_content, start, stop))
+                piece_overlays = [o for o, (_, o_start, o_end) in windows if o_end >= start and o_start <= stop]
+                piece_audio = [a for a in audio_effects or [] if a['end'] >= start and a['start'] <= stop]
+                piece = os.path.join(folder, f"piece{i}{ext}")
+                pieces.append(piece)
+                commands.append(MemeCat.build_command(
+                    video_path, piece, piece_ass, overlays=piece_overlays, audio_effects=piece_audio,
+                    start=start, duration=None if end is None else end - start, overlay_table=overlay_table,
+                ))
+
+            # each piece is its own ffmpeg process, the threads only wait on them
+            log.info("Rendering %d segments", len(commands))
+            with profiler.stage('ffmpeg_encode_segments'), ThreadPoolExecutor(max_workers=workers or len(commands)) as pool:
+                list(pool.map(lambda command: run_ffmpeg(command, stage=None), commands))
+
+            concat_list = os.path.join(folder, 'pieces.txt')
+            with open(concat_list, 'w', encoding='utf-8') as f:
+                f.writelines(f"file '{piece}'\n" for piece in pieces)
+            command = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_list, "-c", "copy", output_path]
+            log.info(" ".join(command))
+            run_ffmpeg(command, stage='ffmpeg_concat')
+
+    @staticmethod
+    def hit_windows(ass_path:str, overlays:list=None, audio_effects=None, overlay_table:dict=None, count=6, context=1.5) -> list[tuple[float, float]]:
+        """
+        Up to `count` (start, end) windows of `context` seconds around effect hits, spread evenly over the video.
+
+        A hit is a caption with style tags or an emoji above it, an overlay or an audio effect starting.
+        Overlapping windows are merged.
+        """
+        times = []
+        with open(ass_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith("Dialogue:"):
+                    fields = line.split(",", 9)
+                    if fields[9].startswith("{") or "\\N" in fields[9]: # tags, or the line break under an emoji
+                        times.append(parse_ass_time(fields[1]))
+        times.extend(MemeCat.resolve_overlay(o, overlay_table)[1] for o in overlays or [])
+        times.extend(float(a['start']) for a in audio_effects or [])
+        times = sorted(set(times))
+        if len(times) > count > 1:
+            times = [times[round(i * (len(times) - 1) / (count - 1))] for i in range(count)]
+        elif len(times) > count:
+            times = times[:count]
+        return merge_windows((round(max(t - context, 0.0), 3), round(t + context, 3)) for t in times)
+
+    @staticmethod
+    def write_preview(video_path: str, output_path: str, ass_path: str, overlays: list = None, audio_effects=None, overlay_table:dict=None, keep:list=None, start=None, end=None, hits=6, context=1.5, height=360):
+        """
+        Render a quick, small look at the result: only the `start` to `end` range (seconds of the output timeline), or
+        else windows around up to `hits` effect hits (see `hit_windows`), shrunk to `height` and encoded as fast as possible.
 
-        print(" ".join(command))
+        Captions need no change at a smaller size (libass scales the script's PlayRes to the frame, borders included),
+        the overlays are scaled along with the video. Takes the rest of the parameters of `write`.
+        """
+        if start is not None or end is not None:
+            if end is None:
+                end = kept_seconds(keep) if keep else probe_duration(video_path)
+            windows = [(float(start or 0.0), float(end))]
+        else:
+            windows = MemeCat.hit_windows(ass_path, overlays, audio_effects, overlay_table, count=int(hits), context=float(context))
+            if not windows:
+                windows = [(0.0, 2 * float(context) * int(hits))]
+                log.info("No effect hits, previewing the first %.1fs", windows[0][1])
+        proxy_scale = None
+        if height:
+            source_height = probe_height(video_path)
+            if source_height > height:
+                proxy_scale = round(height / source_height, 6)
+
+        if len(windows) == 1 and not keep: # one range: seek to it instead of decoding everything before it
+            (start, end), = windows
+            command = MemeCat.build_command(video_path, output_path, ass_path, overlays=overlays, audio_effects=audio_effects, start=start, duration=round(end - start, 3), overlay_table=overlay_table, proxy_scale=proxy_scale, output_options=PREVIEW_OPTIONS)
+        else:
+            command = MemeCat.build_command(video_path, output_path, ass_path, overlays=overlays, audio_effects=audio_effects, overlay_table=overlay_table, keep=keep, windows=windows, proxy_scale=proxy_scale, output_options=PREVIEW_OPTIONS)
+        log.info("Previewing %s", ", ".join(f"{start:.1f}-{end:.1f}s" for start, end in windows))
+        log.info(" ".join(command))
+        run_ffmpeg(command)
+
+    @staticmethod
+    def write(video_path: str, output_path: str, ass_path: str, overlays: list = None, audio_copy=True, audio_effects=None, segments=1, render_workers=None, overlay_table:dict=None, keep:list=None):
+        """
+        Write the captions and overlays onto a video with specific configurations.
+
+        Parameters:
+        - video_path (str): Path to the input video.
+        - overlays (list): `OverlayHit`s from `prepare`, resolved through `overlay_table`, or overlay configurations.
+            Each configuration is a dictionary with keys:
+                - 'src': Path to the image.
+                - 'x': X position of the image.
+                - 'y': Y position of the image.
+                - 'width': Width of the image (optional).
+                - 'height': Height of the image (optional).
+                - 'start_time': Start time (in seconds).
+                - 'end_time': End time (in seconds).
+        - output_path (str): Path to save the output video.
+        - ass_path (str): Path to the ASS subtitle file to burn in (required).
+        - audio_copy (bool): Whether to copy audio without re-encoding.
+        - segments (int): Above 1, render that many pieces in parallel and join them (see `write_segmented`).
+        - render_workers (int): How many of those pieces render at once.
+        - overlay_table (dict): Overlay configurations by id (the bucket's `overlays`) for `OverlayHit`s.
+        - keep (list): (start, end) spans of the input to keep, from `prepare` with `remove_silence`. The captions,
+            overlays and audio effects are then on the cut timeline. Always rendered in one pass.
+
+        Returns:
+        - None
+        """
+        if keep and segments > 1:
+            log.info("Silence removal renders in one pass, not in %d segments", segments)
+            segments = 1
+        if segments > 1:
+            return MemeCat.write_segmented(video_path, output_path, ass_path, overlays=overlays, audio_effects=audio_effects, segments=segments, workers=render_workers, overlay_table=overlay_table)
+
+        command = MemeCat.build_command(video_path, output_path, ass_path, overlays=overlays, audio_effects=audio_effects, overlay_table=overlay_table, keep=keep)
+
+        log.info(" ".join(command))
 
         # Run the command
-        subprocess.run(command, check=True)
+        run_ffmpeg(command)
         
 def main():
     parser = argparse.ArgumentParser(description="Create a video with overlaid subtitles from audio using Whisper and FFmpeg, similar to CapCut style.")
     # The videos
-    parser.add_argument('--input_video', required=True, help="Path to the input video.")
-    parser.add_argument('--output_video', required=True, help="Path to the output video.")
+    parser.add_argument('--input_video', help="Path to the input video.")
+    parser.add_argument('--output_video', help="Path to the output video.")
+    parser.add_argument('--segments', type=int, default=1, help="Render the output as this many keyframe aligned pieces in parallel, joined losslessly")
+    parser.add_argument('--segment_workers', type=int, default=None, help="How many pieces render at once (default: all of them)")
+    parser.add_argument('--variants', default=None, help="YAML/JSON list of output versions (output, size, crop, captions and any setting to change) made from one transcription and one decode")
+    # Preview mode
+    parser.add_argument('--preview', action='store_true', help="Render a small, fast preview instead: a time range, or windows around the effect hits")
+    parser.add_argument('--preview_start', type=float, default=None, help="Preview mode: start of the range to render (seconds)")
+    parser.add_argument('--preview_end', type=float, default=None, help="Preview mode: end of the range to render (seconds)")
+    parser.add_argument('--preview_hits', type=int, default=6, help="Preview mode without a range: how many effect hits to show")
+    parser.add_argument('--preview_context', type=float, default=1.5, help="Preview mode without a range: seconds shown before and after each hit")
+    parser.add_argument('--preview_height', type=int, default=360, help="Preview mode: proxy resolution height (0 keeps the input's)")
+    # Batch mode
+    parser.add_argument('--batch', default=None, help="Process many videos: a directory, a glob pattern or a manifest (.yml/.json/.txt)")
+    parser.add_argument('--output_dir', default=None, help="Batch mode: where outputs go when the manifest does not say (default: next to each input)")
+    parser.add_argument('--jobs', type=int, default=2, help="Batch and server mode: worker processes transcribing in parallel, each keeping its models loaded")
+    parser.add_argument('--render_jobs', type=int, default=None, help="Batch and server mode: concurrent ffmpeg renders (default: same as --jobs)")
+    parser.add_argument('--report', default='batch_report.json', help="Batch mode: per-job status and timing report")
+    # Server mode
+    parser.add_argument('--serve', action='store_true', help="Keep the models loaded and take jobs over a local HTTP API (see lib/server.py)")
+    parser.add_argument('--host', default='127.0.0.1', help="Server mode: address to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="Server mode: port to listen on")
+    parser.add_argument('--socket', default=None, help="Server mode: listen on this Unix socket instead of a port")
+    parser.add_argument('--max_queue', type=int, default=32, help="Server mode: most jobs queued or running at once, more are refused with 503")
+    parser.add_argument('--stub_models', action='store_true', help="Server mode: use offline stand-in models (no downloads, made up words) for local testing")
     # Semantic Search vars
     parser.add_argument('--bucket', default='buckets/nate.yml', help="The default Effects and Style Bucket to use for captions")
     parser.add_argument('--model', default='small', help="Whisper model size (e.g., tiny, base, small, medium, large).")
+    parser.add_argument('--transcribe_workers', type=int, default=1, help="Split the audio at silences and transcribe the chunks on this many processes")
+    parser.add_argument('--chunk_seconds', type=float, default=60.0, help="Target chunk length when transcribing in parallel")
+    parser.add_argument('--remove_silence', type=float, default=None, help="Cut every pause longer than this many seconds out of the video (captions and effects follow the cuts)")
+    parser.add_argument('--silence_padding', type=float, default=0.15, help="With --remove_silence: seconds of each cut pause kept next to the words")
+    parser.add_argument('--stream', action='store_true', help="Search and write captions while whisper is still transcribing (chunked at silences like --transcribe_workers)")
     parser.add_argument('--words', default=1, help="How many words can be on screen at the same time.")
     parser.add_argument('--threshold', default=0.2, help="Semantic search threshold (how close to the same meaning as your bucket tags)")
     parser.add_argument('--n', default=2, help="Semantic search effect result max (how many relevant effects can be stacked)")
+    parser.add_argument('--match', default=None, choices=MATCH_MODES, help="How captions match bucket tags: exact words, exact then semantic (hybrid), or semantic only. Overrides the bucket's config")
+    parser.add_argument('--index', default=None, choices=INDEXES, help="How the bucket is searched: exact scans every tag, ivf clusters them and only scans the closest clusters (for very large buckets). Overrides the bucket's config")
+    parser.add_argument('--nprobe', type=int, default=None, help="With --index ivf: clusters scanned per search, higher is slower but closer to exact")
+    parser.add_argument('--embedding_dtype', default='float32', choices=DTYPES, help="How bucket tag embeddings are kept in memory: float16 halves it and int8 quarters it, for slightly less exact scores")
+    parser.add_argument('--batch_size', type=int, default=64, help="How many caption chunks are embedded at once during semantic search")
+    parser.add_argument('--search_cache_size', type=int, default=4096, help="How many distinct caption texts keep their search results in memory (0 disables)")
+    parser.add_argument('--cache_dir', default=None, help="Where to keep caches between runs (default: $MEMECAT_CACHE or ~/.cache/memecat)")
+    parser.add_argument('--no_embedding_cache', action='store_true', help="Always re-embed the bucket keys instead of loading them from the cache")
+    parser.add_argument('--no_transcript_cache', action='store_true', help="Always run whisper instead of reusing a cached transcript of the same audio")
+    # Transcripts
+    parser.add_argument('--transcript_in', default=None, help="Use this transcript JSON (as written by --transcript_out, or a list of [start, end, text]) instead of running whisper")
+    parser.add_argument('--transcript_out', default=None, help="Also save the transcript as JSON here for reuse or hand editing")
     # Default Style overrides
     parser.add_argument('--font', default='Impact', help="Default font to use for subtitles.")
     parser.add_argument('--font_size', type=int, default=180, help="Font size for subtitles.")
     parser.add_argument('--primary_color', default='&H00FFFFFF&', help="Primary color for subtitles in ASS format. Default is white.")
+    # Diagnostics
+    parser.add_argument('--profile', default=None, help="Write a JSON report of wall/CPU time and peak memory per stage, search counts and ffmpeg speed here")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Log progress (-v), and every match and effect (-vv)")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only log errors")
     args = parser.parse_args()
-    
-    MemeCat.burn(
-        args.input_video,
-        args.output_video,
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+    log.setLevel(logging.ERROR if args.quiet else (logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+    if args.batch is None and not args.serve and (args.input_video is None or (args.output_video is None and args.variants is None)):
+        parser.error("either --input_video and --output_video (or --variants), --batch or --serve is required")
+
+    settings = dict(
         bucket_path=args.bucket,
-        model=args.model,
         words=args.words,
         threshold=args.threshold,
         n=args.n,
         font=args.font,
         font_size=args.font_size,
         primary_color=args.primary_color,
+        batch_size=args.batch_size,
+        cache_dir=args.cache_dir,
+        embedding_cache=not args.no_embedding_cache,
+        search_cache_size=args.search_cache_size,
+        match=args.match,
+        index=args.index,
+        nprobe=args.nprobe,
+        embedding_dtype=args.embedding_dtype,
+        transcript_cache=not args.no_transcript_cache,
+        transcribe_workers=args.transcribe_workers,
+        chunk_seconds=args.chunk_seconds,
+        stream=args.stream,
+        remove_silence=args.remove_silence,
+        silence_padding=args.silence_padding,
     )
+
+    if args.batch is not None:
+        from lib.batch import collect_jobs, run_batch
+        jobs = collect_jobs(args.batch, output_dir=args.output_dir)
+        report = run_batch(jobs, settings, workers=args.jobs, render_workers=args.render_jobs, report_path=args.report, model=args.model)
+        if not args.quiet:
+            print(f"Batch finished: {report['summary']}, report in {args.report}")
+        return
+
+    if args.serve:
+        from lib.server import RenderServer, serve
+        render = RenderServer(settings, model=args.model, asr_workers=args.jobs, render_workers=args.render_jobs or args.jobs, max_queue=args.max_queue, stub=args.stub_models)
+        if not args.quiet:
+            print(f"Serving on {args.socket or f'http://{args.host}:{args.port}'} once the models are loaded, Ctrl+C to stop")
+        serve(render, host=args.host, port=args.port, socket_path=args.socket)
+        return
+    
+    variants = None
+    if args.variants is not None:
+        with open(args.variants, 'r', encoding='utf-8') as f:
+            variants = yaml.safe_load(f) # YAML is a superset of JSON
+
+    if args.profile is not None:
+        profile.enable()
+        profiler.set('input_video', args.input_video)
+        profiler.set('settings', dict(settings, model=args.model, segments=args.segments))
+    try:
+        with profiler.stage('burn'):
+            MemeCat.burn(
+                args.input_video,
+                args.output_video,
+                model=args.model,
+                transcript_in=args.transcript_in,
+                transcript_out=args.transcript_out,
+                segments=args.segments,
+                render_workers=args.segment_workers,
+                preview=args.preview,
+                preview_start=args.preview_start,
+                preview_end=args.preview_end,
+                preview_hits=args.preview_hits,
+                preview_context=args.preview_context,
+                preview_height=args.preview_height,
+                variants=variants,
+                **settings,
+            )
+    finally:
+        if args.profile is not None:
+            profiler.save(args.profile)
+            log.info("Profile written to %s", args.profile)
+    if not args.quiet:
+        created = ", ".join(v['output'] for v in variants) if variants else args.output_video
+        print(f"Done! Created {created} with burned-in subtitles{' (preview)' if args.preview and not variants else ''}.")
     
 
 if __name__ == "__main__":